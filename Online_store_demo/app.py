@@ -1,57 +1,297 @@
+import hmac
 import os
+import time
 
-from flask import Flask, render_template, flash, redirect, session, g
+import click
+from datetime import date
+from flask import Flask, Blueprint, Response, current_app, render_template, flash, redirect, request, session, g, jsonify
+from markupsafe import Markup
+from werkzeug.middleware.proxy_fix import ProxyFix
 # from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 from forms import *
 from models import *
-from convert import Convert
-import pandas as pd
+from convert import Convert, refresh_rates
+import migrations
+import bulk
+import sales
+from cart import Cart
+from cart_store import make_cart_store
+from jobs import Worker, make_job_queue, start_worker_thread
+from identity import identities
+from throttle import Throttle, make_bucket_store
+from caching import cached_page, cache_headers, fingerprints
+from fragments import cards
+from pricing import PriceBook, convert, format_minor
+from dbpool import engine_options, register_pool_gauges
+from metrics import registry
+import instrumentation
 
 CURR_USER_KEY = "curr_user"
 CART = 'cart'
 ADMIN_ID = os.environ.get('ADMIN_ID', 'Kolobok_admin')
 
-app = Flask(__name__)
+bp = Blueprint('shop', __name__, cli_group = None)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///shop'))
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-# app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-# toolbar = DebugToolbarExtension(app)
+def default_config():
+    '''Settings read from the environment when the app is created.'''
 
-app.app_context().push()
-connect_db(app)
-db.create_all()
+    return {
+        # Get DB_URI from environ variable (useful for production/testing) or,
+        # if not set there, use development local db.
+        'SQLALCHEMY_DATABASE_URI': os.environ.get('DATABASE_URL', 'postgresql:///shop'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'SQLALCHEMY_ECHO': False,
+        # 'DEBUG_TB_INTERCEPT_REDIRECTS': True,
+        'SECRET_KEY': os.environ.get('SECRET_KEY', "it's a secret"),
+        'PRODUCTS_PER_PAGE': int(os.environ.get('PRODUCTS_PER_PAGE', 24)),
+        'ORDERS_PER_PAGE': int(os.environ.get('ORDERS_PER_PAGE', 20)),
+        'CART_STORE': os.environ.get('CART_STORE', 'db'),
+        'THROTTLE_STORE': os.environ.get('THROTTLE_STORE', 'memory'),
+        'THROTTLE_USER': os.environ.get('THROTTLE_USER', '5/60'),       # attempts / seconds
+        'THROTTLE_IP': os.environ.get('THROTTLE_IP', '30/60'),
+        'PROXY_HOPS': int(os.environ.get('PROXY_HOPS', 0)),             # trusted proxies setting X-Forwarded-For
+        'CHECKOUT_MODE': os.environ.get('CHECKOUT_MODE', 'sync'),        # sync or async (see jobs.py)
+        'JOB_QUEUE': os.environ.get('JOB_QUEUE', 'db'),
+        'CHECKOUT_MAX_ATTEMPTS': int(os.environ.get('CHECKOUT_MAX_ATTEMPTS', 5)),
+        'METRICS_TOKEN': os.environ.get('METRICS_TOKEN'),               # bearer token for scrapers
+        'SERVER_TIMING': os.environ.get('SERVER_TIMING', 'false').lower() in ('1', 'true', 'yes', 'on'),
+    }
+
+
+def create_app(config = None):
+    '''Build the app. `config` overrides the environment defaults.
+
+    Nothing here touches the database, so importing and creating the app
+    is cheap for every worker and test. Create the schema with
+    `flask init-db`.'''
+
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          engine_options(os.environ, app.config['SQLALCHEMY_DATABASE_URI']))
+    # toolbar = DebugToolbarExtension(app)
+
+    if app.config['PROXY_HOPS']:                        # remote_addr is the client, not the proxy
+        hops = app.config['PROXY_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for = hops, x_proto = hops, x_host = hops)
+
+    connect_db(app)
+    instrumentation.init_app(app)
+
+    app.extensions['cart_store'] = make_cart_store(app.config['CART_STORE'])
+    app.extensions['job_queue'] = make_job_queue(app.config['JOB_QUEUE'])
+
+    if app.config['CHECKOUT_MODE'] == 'async' and app.config['JOB_QUEUE'] == 'memory':
+        start_worker_thread(app, checkout_worker(app.extensions['job_queue'], app.config), poll = 0.1)
+
+    throttle_store = make_bucket_store(app.config['THROTTLE_STORE'])
+    app.extensions['throttles'] = {
+        'user': Throttle.from_spec(throttle_store, app.config['THROTTLE_USER']),
+        'ip': Throttle.from_spec(throttle_store, app.config['THROTTLE_IP']),
+    }
+
+    app.add_template_global(fingerprints.url, 'static_url')
+    app.add_template_filter(format_minor, 'money')
+
+    app.register_blueprint(bp)
+    return app
+
+
+def cart_store():
+    return current_app.extensions['cart_store']
+
+
+def job_queue():
+    return current_app.extensions['job_queue']
+
+
+def checkout_worker(queue, config):
+    '''Worker that finalizes async checkouts (Order.reserve) from `queue`.'''
+
+    return Worker(queue, {'checkout': (Order.finalize, Order.cancel)},
+                  max_attempts = config['CHECKOUT_MAX_ATTEMPTS'])
+
+
+price_book = PriceBook(Product.price_vector, CatalogVersion.current)
+
+register_pool_gauges(lambda: db.engine)
+
+
+##############################################################################
+# CLI
+
+
+@bp.cli.command('init-db')
+def init_db_command():
+    '''Create the database schema (runs all migrations).'''
+
+    migrations.upgrade(db.engine, log = click.echo)
+    click.echo("Database is ready.")
+
+
+@bp.cli.command('refresh-rates')
+@click.option('--every', type = int, default = 0,
+              help = 'Keep running and refresh every N seconds.')
+def refresh_rates_command(every):
+    '''Store fresh currency rate snapshots.
+
+    With --every a failed fetch or a database error is reported and the
+    next round runs as usual; prices keep the last stored rates meanwhile.'''
+
+    while True:
+        try:
+            snapshots, failed = refresh_rates()
+        except Exception as e:                          # e.g. the database is down for a moment
+            db.session.rollback()
+            if not every:
+                raise
+            click.echo(f"Refresh failed, trying again in {every}s: {type(e).__name__}: {e}", err = True)
+            time.sleep(every)
+            continue
+
+        for snapshot in snapshots:
+            click.echo(f"{snapshot.label}: {snapshot.rate}")
+        for label, error in failed.items():
+            click.echo(f"{label}: not refreshed, {error}", err = True)
+
+        if not every:
+            if failed:
+                raise click.ClickException("Some rates were not refreshed.")
+            break
+        time.sleep(every)
+
+
+@bp.cli.command('db-upgrade')
+def db_upgrade_command():
+    '''Apply pending schema migrations.'''
+
+    if not migrations.upgrade(db.engine, log = click.echo):
+        click.echo("Database is up to date.")
+
+
+@bp.cli.command('products-import')
+@click.argument('source', type = click.File('r', encoding = 'utf-8'))
+@click.option('--format', 'fmt', type = click.Choice(['csv', 'jsonl', 'json']),
+              help = 'Defaults to the file extension (csv for stdin).')
+@click.option('--batch-size', type = int, default = 1000, show_default = True)
+def products_import_command(source, fmt, batch_size):
+    '''Upsert products by name from a CSV, JSON Lines or JSON file ("-" for stdin).'''
+
+    try:
+        count, seconds = bulk.import_products(source, fmt or bulk.guess_format(source.name), batch_size)
+    except ValueError as e:
+        raise click.ClickException(f"{e}. Nothing was imported.")
+
+    click.echo(f"Imported {count} products in {seconds:.2f}s ({count / max(seconds, 1e-9):.0f} rows/sec).",
+               err = True)
+
+
+@bp.cli.command('products-export')
+@click.argument('target', type = click.File('w', encoding = 'utf-8'))
+@click.option('--format', 'fmt', type = click.Choice(['csv', 'jsonl', 'json']),
+              help = 'Defaults to the file extension (csv for stdout).')
+@click.option('--batch-size', type = int, default = 1000, show_default = True)
+def products_export_command(target, fmt, batch_size):
+    '''Write every product to a CSV, JSON Lines or JSON file ("-" for stdout).'''
+
+    count, seconds = bulk.export_products(target, fmt or bulk.guess_format(target.name), batch_size)
+    click.echo(f"Exported {count} products in {seconds:.2f}s ({count / max(seconds, 1e-9):.0f} rows/sec).",
+               err = True)
+
+
+@bp.cli.command('products-update')
+@click.argument('source', type = click.File('r', encoding = 'utf-8'))
+@click.option('--format', 'fmt', type = click.Choice(['csv', 'jsonl', 'json']),
+              help = 'Defaults to the file extension (csv for stdin).')
+def products_update_command(source, fmt):
+    '''Apply stock and price changes from a CSV, JSON Lines or JSON file ("-" for stdin).
+
+    Columns: id or name, quantity or quantity_delta, price.'''
+
+    try:
+        items = list(bulk.read_rows(source, fmt or bulk.guess_format(source.name)))
+    except ValueError as e:
+        raise click.ClickException(f"{e}. Nothing was updated.")
+
+    results = bulk.update_stock(items)
+
+    for r in results:
+        if r['status'] != 'updated':
+            click.echo(f"row {r['item'] + 1}: {r['status']} {r.get('error', '')}".rstrip(), err = True)
+
+    updated = sum(r['status'] == 'updated' for r in results)
+    click.echo(f"Updated {updated} of {len(results)} rows.", err = True)
+
+
+@bp.cli.command('checkout-worker')
+@click.option('--once', is_flag = True, help = 'Run the jobs that are due and exit.')
+@click.option('--poll', type = float, default = 1.0, show_default = True,
+              help = 'Seconds to wait when the queue is empty.')
+def checkout_worker_command(once, poll):
+    '''Finalize orders placed with CHECKOUT_MODE=async.'''
+
+    worker = checkout_worker(job_queue(), current_app.config)
+
+    if once:
+        total = 0
+        while ran := worker.run_once():
+            total += ran
+        click.echo(f"Ran {total} jobs.")
+    else:
+        click.echo("Waiting for checkout jobs (Ctrl+C to stop).")
+        worker.run(poll = poll)
+
+
+@bp.cli.command('sales-rollup')
+@click.option('--since', type = click.DateTime(['%Y-%m-%d']),
+              help = 'Only rebuild this day and later (default: everything).')
+def sales_rollup_command(since):
+    '''Rebuild the sales rollups from the orders (catch-up after a restore or import).'''
+
+    written = sales.rebuild(db.session.connection(), since.date() if since else None)
+    db.session.commit()
+    click.echo(f"Wrote {written} rollup rows.")
+
+
+@bp.cli.command('db-status')
+def db_status_command():
+    '''List schema migrations and whether they ran.'''
+
+    for version, description, done in migrations.status(db.engine):
+        click.echo(f"[{'x' if done else ' '}] {version} {description}")
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     '''If user logged in, add curr user to Flask global.'''
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    if CURR_USER_KEY in session:                        # usually answered from the identity cache, no query
+        g.user = identities.get(session[CURR_USER_KEY], load_user, is_admin, loader = load_user)
 
     else:
         g.user = None
 
 
+def load_user(user_id):
+    return db.session.get(User, user_id)
+
+
+def is_admin(user):
+    return user.username in ADMIN_ID
+
+
 def do_login(user):
     '''Log in user.'''
 
     session[CURR_USER_KEY] = user.id
-
-    if CART not in session:
-        session[CART] = []
+    session[CART] = cart_store().for_user(user.id)        # the cart itself stays on the server
 
 
 def do_logout():
@@ -61,29 +301,97 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def throttled(username):
+    '''True if this login/signup attempt is over the per-IP or per-username
+    limit. Checked before any password hashing happens.
+
+    The IP is request.remote_addr: behind a reverse proxy set PROXY_HOPS,
+    or every client shares the proxy's address and bucket.'''
+
+    throttles = current_app.extensions['throttles']
+    return not (throttles['ip'].allow(f"ip:{request.remote_addr}")
+                and throttles['user'].allow(f"user:{username}"))
+
+
+def get_cart_id():
+    '''Id of the current user's server-side cart.
+
+    Sessions from before the cart moved server side still hold the
+    cart lines themselves; those are copied into the store once.'''
+
+    cart_id = session.get(CART)
+
+    if not isinstance(cart_id, str):
+        old_cart = Cart.from_session(cart_id)
+        cart_id = cart_store().for_user(g.user.id)
+        for product_id, quantity in old_cart.items():
+            cart_store().set_line(cart_id, product_id, quantity)
+        session[CART] = cart_id
+
+    return cart_id
+
+
+def catalog_page(render, currency, *parts):
+    '''cached_page keyed on everything a catalog page shows: catalog version,
+    currency and rate, and the logged in user (nav bar, admin buttons).'''
+
+    return cached_page(render,
+                       CatalogVersion.current(),
+                       currency.get('label'), currency.get('rate_id'), currency.get('rate'),
+                       g.user.id, g.user.username, g.user.location, g.user.image_url,
+                       *parts)
+
+
+@bp.app_template_global()
+def product_card(product, currency):
+    '''Rendered card for `product`, cached per product version and currency rate.'''
+
+    key = (product.id, product.version, currency.get('label'), currency.get('rate_id'), currency.get('rate'))
+    html = cards.get(key)
+
+    if html is None:
+        html = current_app.jinja_env.get_template('products/_card.html').render(
+            p = product, 
+            currency = currency,
+            price = local_price(product, currency))
+        cards.set(key, html)
+
+    return Markup(html)
+
+
+@bp.app_template_global()
+def local_price(product, currency):
+    '''Price of `product` in the currency's minor units, from the shared price vector.'''
+
+    price = price_book.prices(currency).get(product.id)
+    return price if price is not None else convert(product.price_cents, currency.get('rate'))
+
+
 def get_currency(location): # pass location as var
     '''Getting currency based on user's location'''
     return Convert.check(location)    
     # return currency
 
-@app.route('/')
+@bp.route('/')
 def homepage():
     '''Show homepage'''
     if g.user:
         if g.user.location:
-            products = (Product
-                        .query
-                        .order_by(Product.name)
-                        .all())
-            
             currency = get_currency(g.user.location)
 
-            return render_template('home.html', currency = currency, products=products, ADMIN_ID = ADMIN_ID)
+            return catalog_page(lambda: render_template(
+                                    'home.html', 
+                                    currency = currency, 
+                                    products = Product.page(current_app.config['PRODUCTS_PER_PAGE'],
+                                                            after = request.args.get('after'),
+                                                            before = request.args.get('before')),
+                                    ADMIN_ID = ADMIN_ID),
+                                currency)
     else:
         return render_template('home-anon.html')
         
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def admin_signup():
     '''Handle user signup. Only admin of the website
         is allowed to add new users.'''
@@ -94,6 +402,10 @@ def admin_signup():
 
         form = UserAddForm()
 
+        if request.method == 'POST' and throttled(g.user.username):
+            flash("Too many sign ups in a row. Please wait a minute and try again.", 'danger')
+            return render_template('admin/signup.html', form=form, ADMIN_ID = ADMIN_ID), 429
+
         if form.validate_on_submit():
             try:
                 User.signup(
@@ -118,12 +430,16 @@ def admin_signup():
     else: return redirect ('/')
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     '''Handle user login.'''
 
     form = LoginForm()
 
+    if request.method == 'POST' and throttled(request.form.get('username', '')):
+        flash("Too many login attempts. Please wait a minute and try again.", 'danger')
+        return render_template('users/login.html', form=form), 429
+
     if form.validate_on_submit():
         user = User.authenticate(form.username.data,
                                  form.password.data)
@@ -138,7 +454,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/users/<int:user_id>/delete', methods=["POST"])
+@bp.route('/users/<int:user_id>/delete', methods=["POST"])
 def user_delete(user_id):
     '''Delete user.'''
 
@@ -150,11 +466,12 @@ def user_delete(user_id):
     
     db.session.delete(user)
     db.session.commit()
+    identities.invalidate(user_id)
 
     return redirect("/")
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     '''Handle logout of user.'''
 
@@ -167,7 +484,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users/update', methods=["GET", "POST"])
+@bp.route('/users/update', methods=["GET", "POST"])
 def user_update():
     '''Update profile for current user.'''
 
@@ -178,7 +495,7 @@ def user_update():
     form = UserEditFrom()
 
     if form.validate_on_submit(): 
-        user = User.query.get_or_404(session[CURR_USER_KEY])
+        user = g.user.user                              # loaded once, reused by User.edit
 
         email = form.email.data if form.email.data else user.email 
         image_url = form.image_url.data if form.image_url.data else user.image_url
@@ -188,11 +505,12 @@ def user_update():
         pw = form.password.data if form.password.data else redirect('/')
 
 
-        user = User.edit(user.id, email, image_url, pw, location, address)
+        user = User.edit(user, email, image_url, pw, location, address)
 
         if user:
             db.session.add(user)
             db.session.commit()
+            identities.invalidate(user.id)              # again after commit, so a read racing it can't re-cache old values
             flash("Profile updated.", "success")
             return redirect(f'/users/{user.id}')
         else: 
@@ -202,7 +520,7 @@ def user_update():
     return render_template('users/edit.html', form=form)
 
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
 def users_show(user_id):
     '''Show user profile.'''
 
@@ -217,17 +535,16 @@ def users_show(user_id):
 
     user = User.query.get_or_404(user_id)
 
-    orders = (Order   
-                .query
-                .filter(Order.user_id == user.id)
-                .order_by(Order.timestamp)
-                .limit(10)
-                .all())
+    orders = Order.history(user.id, 10)
 
-    return render_template('users/show.html', user = user, ADMIN_ID = ADMIN_ID, orders = orders)
+    return render_template('users/show.html', 
+                           user = user, 
+                           ADMIN_ID = ADMIN_ID, 
+                           orders = orders,
+                           order_count = Order.count_for(user.id))
 
 
-@app.route('/users/<int:user_id>/orders')
+@bp.route('/users/<int:user_id>/orders')
 def users_orders(user_id):
 
     if not g.user:
@@ -240,14 +557,20 @@ def users_orders(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    orders = user.orders
+    orders = Order.history(user.id, current_app.config['ORDERS_PER_PAGE'],
+                           after = request.args.get('after'),
+                           before = request.args.get('before'))
 
-    return render_template('users/orders.html', user = user, ADMIN_ID = ADMIN_ID, orders = orders)
+    return render_template('users/orders.html', 
+                           user = user, 
+                           ADMIN_ID = ADMIN_ID, 
+                           orders = orders,
+                           order_count = Order.count_for(user.id))
 
 ##############################################################################
 # Products routes:
 
-@app.route('/products/new', methods=["GET", "POST"])
+@bp.route('/products/new', methods=["GET", "POST"])
 def produts_add():
     '''Add a product:
 
@@ -282,7 +605,7 @@ def produts_add():
     return render_template('admin/product_add.html', form=form, ADMIN_ID = ADMIN_ID)
 
 
-@app.route('/products/<int:product_id>', methods=["GET", "POST"])
+@bp.route('/products/<int:product_id>', methods=["GET", "POST"])
 def products_show(product_id):
     '''Show a product.'''
 
@@ -309,36 +632,27 @@ def products_show(product_id):
                   the moment. Please choose lower quantity.""", 'warning')
             return redirect(f'/products/{product.id}')
         
-        cart_list = session[CART]
-        
-        cart_list.append(
-            {
-                'product_id': product_id,
-                'quantity' : quantity,
-            }
-        )
-
-        df = pd.DataFrame(cart_list)                    # checking for duplicates in a cart. If found removes old entery
-        df.drop_duplicates(subset = ['product_id'], keep = 'last', inplace = True)
-        new_cart_list = df.to_dict('records')
-        
-        if new_cart_list != cart_list:
+        if cart_store().set_line(get_cart_id(), product_id, quantity):
             flash('No duplicates in a cart allowed. Previous entery was removed.')
-        session[CART] = new_cart_list
-        
-
 
         flash("Item added to your cart", "success")
         return redirect('/')    
 
-    return render_template('products/details.html', 
-                           product = product, 
-                           currency = currency, 
-                           form = form,
-                           ADMIN_ID = ADMIN_ID)
+    render = lambda: render_template('products/details.html', 
+                                     product = product, 
+                                     currency = currency, 
+                                     form = form,
+                                     ADMIN_ID = ADMIN_ID)
+
+    if request.method != 'GET' or form.errors:
+        return render()
+
+    return catalog_page(render, currency,
+                        product.quantity,                               # stock moves without a catalog version bump
+                        int(time.time() // 1800))                       # renew the embedded CSRF token well within its 1h life
 
 
-@app.route('/products/<int:product_id>/update', methods=["GET", "POST"])
+@bp.route('/products/<int:product_id>/update', methods=["GET", "POST"])
 def product_update(product_id):
     '''Update product. ONLY FOR ADMIN'''
 
@@ -374,7 +688,28 @@ def product_update(product_id):
     return render_template('products/edit.html', form=form, product = product)
 
 
-@app.route('/products/<int:product_id>/delete', methods = ['POST'])
+@bp.route('/products/batch', methods = ['POST'])
+def products_batch_update():
+    '''Apply many stock and price changes at once. ONLY FOR ADMIN
+
+    Takes a JSON list (or {"updates": [...]}) of items like
+    {"id": 3, "quantity_delta": 24} or {"name": "Bread loaf", "quantity": 10, "price": "3.49"}
+    and returns a result per item (see bulk.update_stock).'''
+
+    if not g.user or not is_admin(g.user):
+        return jsonify(error = "Access unauthorized."), 403
+
+    payload = request.get_json(silent = True)            # JSON only, so a cross-site form can't post here
+    items = payload.get('updates') if isinstance(payload, dict) else payload
+
+    if not isinstance(items, list):
+        return jsonify(error = 'Expected a JSON list of updates.'), 400
+
+    results = bulk.update_stock(items)
+    return jsonify(updated = sum(r['status'] == 'updated' for r in results), results = results)
+
+
+@bp.route('/products/<int:product_id>/delete', methods = ['POST'])
 def product_delete(product_id):
     '''Delete a product. ONLY FOR ADMIN'''
 
@@ -384,7 +719,9 @@ def product_delete(product_id):
 
     product = Product.query.get_or_404(product_id)
     db.session.delete(product)
+    CatalogVersion.bump()
     db.session.commit()
+    cards.drop_product(product_id)
 
     return redirect('/')
 
@@ -392,49 +729,66 @@ def product_delete(product_id):
 
 ####### CATEGORIES
 
-@app.route('/categories', methods = ['GET'])
+@bp.route('/categories', methods = ['GET'])
 def categories_show():
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-        
-    products = Product.query.all()
 
-    categories = []
-    
-    for p in products:
-        categories.append(p.category)
-    
-    categories = list(set(categories))
-    
-    return render_template('products/categories.html', categories = categories)
+    return cached_page(lambda: render_template('products/categories.html', 
+                                               categories = Product.categories()),
+                       CatalogVersion.current(),
+                       g.user.id, g.user.username, g.user.location, g.user.image_url)
 
-@app.route('/categories/<category>', methods = ['GET'])
+@bp.route('/categories/<category>', methods = ['GET'])
 def categories_filter(category):
 
     if g.user:
         if g.user.location:
-            products = (Product
-                        .query
-                        .order_by(Product.name)
-                        .filter(Product.category == category)
-                        .all())
-            
             currency = get_currency(g.user.location)
 
-            return render_template('home.html', 
-                                   currency = currency, 
-                                   products=products, 
-                                   ADMIN_ID = ADMIN_ID)
+            return catalog_page(lambda: render_template(
+                                    'home.html', 
+                                    currency = currency, 
+                                    products = Product.page(current_app.config['PRODUCTS_PER_PAGE'],
+                                                            after = request.args.get('after'),
+                                                            before = request.args.get('before'),
+                                                            category = category),
+                                    ADMIN_ID = ADMIN_ID),
+                                currency)
     else:
         return render_template('home-anon.html')
 
 
 
+@bp.route('/search', methods = ['GET'])
+def search_view():
+    '''Products matching ?q=, best match first.'''
+
+    if not g.user:
+        return render_template('home-anon.html')
+
+    terms = request.args.get('q', '').strip()[:200]
+    currency = get_currency(g.user.location)
+
+    if not terms:
+        return render_template('products/search.html', q = '', products = [], currency = currency)
+
+    return catalog_page(lambda: render_template(
+                            'products/search.html',
+                            q = terms,
+                            currency = currency,
+                            products = Product.search(terms, current_app.config['PRODUCTS_PER_PAGE'],
+                                                      after = request.args.get('after'),
+                                                      before = request.args.get('before')),
+                            ADMIN_ID = ADMIN_ID),
+                        currency)
+
+
 ####### CART 
 
-@app.route('/cart', methods=['GET', 'POST'])
+@bp.route('/cart', methods=['GET', 'POST'])
 def cart_view():
     ''' This logic assumes that user will not be able to make 
         changes to the cart (delete items or change quantites).
@@ -443,9 +797,8 @@ def cart_view():
         If BMW can sell heated seat subs why can't we XD. 
         JK. It will be added in v1.1 
         
-        It also stores the total in DB in user's currency at rate when
-        of purchase time. But DB does not have the currency field.
-        This will be also address in the v1.1 ''' 
+        It also stores the total in DB in user's currency, together with
+        the currency label and the rate snapshot used at purchase time. '''
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -453,41 +806,38 @@ def cart_view():
     
     user = g.user
     currency = get_currency(user.location)
-    cart = session[CART]
-    products = []
-    total = 0
-
-    for c in cart:
-        products.append(
-            [Product.query.get_or_404(c.get('product_id')), c.get('quantity')]
-        )
-    
-    for p in products:                                              # checking quantity placed with products.quantity in DB
-        if p[0].quantity == 0:
-            flash(f"Sorry, it looks like {p[0].name} is Sold Out and was removed from your cart", 'danger')
-            products.remove(p)
-            session[CART].pop(p[0].id)
-
-        elif p[0].quantity < p[1]:
-            flash(f"{p[0].name} quantity exceeded availabiliy. Changed to maximum avaliable.", 'danger')
-            p[1] = p[0].quantity
+    cart_id = get_cart_id()
+    cart = Product.resolve_cart(cart_store().load(cart_id))           # one query for the whole cart
 
+    for p in cart.sold_out:
+        flash(f"Sorry, it looks like {p.name} is Sold Out and was removed from your cart", 'danger')
+        cart_store().remove_line(cart_id, p.id)
+    for p in cart.reduced:
+        flash(f"{p.name} quantity exceeded availabiliy. Changed to maximum avaliable.", 'danger')
+        cart_store().set_line(cart_id, p.id, p.quantity)
 
-    for p in products:
-        total += (p[0].price * p[1])
-    total = round(total * currency.get('rate'), 2)              # change to currency rate and roundup to 2 decimals
-
+    products = cart.lines
+    total = sum(local_price(p, currency) * q for p, q in products)  # exact, in the currency's minor units
 
     form = PurchaseForm()
     if form.validate_on_submit():
         try:
     
-            Order.add(user.id, total, products)
-            session[CART] = []
+            if current_app.config['CHECKOUT_MODE'] == 'async':
+                order = Order.reserve(user.id, total, products, currency, job_queue())
+                cart_store().clear(cart_id)
+                return redirect(f"/orders/{order.id}")
+
+            Order.add(user.id, total, products, currency)
+            cart_store().clear(cart_id)
 
             flash("Your order has been placed!", 'success')
             return redirect(f"/users/{user.id}/orders")
 
+        except OutOfStock as e:
+                flash(str(e), 'danger')
+                return redirect("/cart")
+
         except IntegrityError:
                 db.session.rollback()
                 flash("Was not able to place an order", 'danger')
@@ -500,34 +850,73 @@ def cart_view():
                            total = total)
 
 
-@app.route('/cart/delete/<int:product_id>')
-def cart_delete(product_id):
+@bp.route('/orders/<int:order_id>')
+def order_status(order_id):
+    '''Status of one order; async checkouts land here while the worker finishes them.'''
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    
-    products = []
 
-    for c in session[CART]:
-        products.append(
-            [Product.query.get_or_404(c.get('product_id')), c.get('quantity')]
-        )
+    order = Order.query.get_or_404(order_id)
+
+    if order.user_id != g.user.id and not is_admin(g.user):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return render_template('users/order_status.html', order = order)
+
+
+@bp.route('/cart/delete/<int:product_id>')
+def cart_delete(product_id):
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
     
-    for p in products:                                              # checking quantity placed with products.quantity in DB
-        if p[0].id == product_id:
-            index = products.index(p)
-            session[CART].pop(index)
+    cart_store().remove_line(get_cart_id(), product_id)
 
     flash('Product was removed from cart T_T', 'warning')
     return redirect('/cart')
 
-@app.after_request
+@bp.route('/admin/sales')
+def sales_report():
+    '''Revenue and units per day, category and product. ONLY FOR ADMIN
+
+    Reads only the sales rollups; ?start=YYYY-MM-DD&end=YYYY-MM-DD, last 30 days by default.'''
+
+    if not g.user or not is_admin(g.user):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    start, end = sales.last_days(30)
+    try:
+        start = date.fromisoformat(request.args.get('start', start.isoformat()))
+        end = date.fromisoformat(request.args.get('end', end.isoformat()))
+    except ValueError:
+        flash("Dates look like 2024-01-31.", "warning")
+
+    return render_template('admin/sales.html', start = start, end = end,
+                           report = sales.report(start, end))
+
+
+@bp.route('/metrics')
+def metrics():
+    '''Prometheus metrics of this worker. ONLY FOR ADMIN, or a scraper
+    sending "Authorization: Bearer <METRICS_TOKEN>".'''
+
+    token = current_app.config['METRICS_TOKEN']
+    sent = request.headers.get('Authorization', '')
+    scraper = bool(token) and hmac.compare_digest(sent.encode(), f"Bearer {token}".encode())
+
+    if not scraper and not (g.user and is_admin(g.user)):
+        return Response("Forbidden\n", status = 403, mimetype = 'text/plain')
+
+    return Response(registry.render(), mimetype = 'text/plain; version=0.0.4')
+
+
+@bp.after_app_request
 def add_header(req):
-    '''Add non-caching headers on every request.'''
+    '''Set caching headers on every response (see caching.cache_headers).'''
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    return cache_headers(req)
@@ -0,0 +1,149 @@
+'''Query plans and latency of the hot query paths, before and after the
+0003 index migration, on a large synthetic dataset.
+
+    python benchmarks/bench_indexes.py --url sqlite:////tmp/bench.db
+    python benchmarks/bench_indexes.py --url postgresql:///shop_bench --products 300000
+
+The database at --url is dropped and rebuilt. Never point it at real data.'''
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy as sa
+from flask import Flask
+
+from models import db, connect_db, User, Product, Order, OrderProduct
+import migrations
+
+INDEXES = ['ix_products_category_name_id',
+           'ix_orders_user_id_timestamp_id',
+           'ix_orders_products_order_id',
+           'ix_orders_products_product_id']
+
+QUERIES = {
+    'category page': (
+        "SELECT id, name FROM products WHERE category = :category "
+        "ORDER BY name, id LIMIT 25"),
+    'order history page': (
+        "SELECT id, timestamp FROM orders WHERE user_id = :user_id "
+        "ORDER BY timestamp DESC, id DESC LIMIT 21"),
+    'order lines': (
+        "SELECT order_id, product_id FROM orders_products WHERE order_id = :order_id"),
+    'orders of a product': (
+        "SELECT order_id FROM orders_products WHERE product_id = :product_id"),
+}
+
+
+def fill(conn, n_products, n_users, n_orders, batch = 10000):
+    '''Synthetic catalog and order history, inserted in executemany batches.'''
+
+    rnd = random.Random(42)
+    categories = [f"category-{i}" for i in range(200)]
+
+    conn.execute(sa.insert(User.__table__), [
+        {'username': f"user{i}", 'email': f"user{i}@example.com", 'location': 'USA',
+         'address': 'somewhere', 'password': 'x'} for i in range(1, n_users + 1)])
+
+    for start in range(0, n_products, batch):
+        conn.execute(sa.insert(Product.__table__), [
+            {'name': f"product-{i:07d}", 'category': rnd.choice(categories), 'weight': 100,
+             'description': 'synthetic', 'price_cents': rnd.randint(100, 5000),
+             'quantity': 100, 'version': 1}
+            for i in range(start, min(start + batch, n_products))])
+
+    epoch = datetime(2020, 1, 1)
+    for start in range(0, n_orders, batch):
+        ids = range(start + 1, min(start + batch, n_orders) + 1)
+        conn.execute(sa.insert(Order.__table__), [
+            {'id': i, 'user_id': rnd.randint(1, n_users), 'total_cents': 1000, 'currency': 'USD',
+             'timestamp': epoch + timedelta(minutes = i)} for i in ids])
+        conn.execute(sa.insert(OrderProduct.__table__), [
+            {'order_id': i, 'product_id': rnd.randint(1, n_products), 'quantity': 1}
+            for i in ids for _ in range(3)])
+
+    return categories
+
+
+def plan(conn, sql, params):
+    if conn.dialect.name == 'sqlite':
+        rows = conn.execute(sa.text("EXPLAIN QUERY PLAN " + sql), params)
+        return [r[-1] for r in rows]
+    return [r[0] for r in conn.execute(sa.text("EXPLAIN " + sql), params)]
+
+
+def timed(conn, sql, param_sets):
+    samples = []
+    for params in param_sets:
+        start = time.perf_counter()
+        conn.execute(sa.text(sql), params).all()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {'p50_ms': round(statistics.median(samples), 3),
+            'p95_ms': round(samples[int(len(samples) * 0.95) - 1], 3)}
+
+
+def measure(conn, args, categories):
+    rnd = random.Random(7)
+    params = {
+        'category page': [{'category': rnd.choice(categories)} for _ in range(args.repeat)],
+        'order history page': [{'user_id': rnd.randint(1, args.users)} for _ in range(args.repeat)],
+        'order lines': [{'order_id': rnd.randint(1, args.orders)} for _ in range(args.repeat)],
+        'orders of a product': [{'product_id': rnd.randint(1, args.products)} for _ in range(args.repeat)],
+    }
+    return {name: {'plan': plan(conn, sql, params[name][0]), **timed(conn, sql, params[name])}
+            for name, sql in QUERIES.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default = os.environ.get('BENCH_DATABASE_URL', 'sqlite:////tmp/shop_bench.db'))
+    parser.add_argument('--products', type = int, default = 100000)
+    parser.add_argument('--users', type = int, default = 2000)
+    parser.add_argument('--orders', type = int, default = 100000)
+    parser.add_argument('--repeat', type = int, default = 200)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.url
+    connect_db(app)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        with db.engine.begin() as conn:
+            for name in INDEXES:
+                conn.execute(sa.text(f"DROP INDEX IF EXISTS {name}"))
+
+            start = time.perf_counter()
+            categories = fill(conn, args.products, args.users, args.orders)
+            print(f"seeded in {time.perf_counter() - start:.1f}s", file = sys.stderr)
+
+        with db.engine.connect() as conn:
+            before = measure(conn, args, categories)
+
+        with db.engine.begin() as conn:
+            migrations.hot_path_indexes(conn)
+            conn.execute(sa.text("ANALYZE"))
+
+        with db.engine.connect() as conn:
+            after = measure(conn, args, categories)
+
+    report = {'url': sa.engine.make_url(args.url).render_as_string(hide_password = True),
+              'rows': {'products': args.products, 'users': args.users,
+                       'orders': args.orders, 'order_lines': args.orders * 3},
+              'queries': {name: {'before': before[name], 'after': after[name]} for name in QUERIES}}
+    print(json.dumps(report, indent = 2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+'''Per-route latency of the shop through the Flask test client.
+
+Boots create_app() against SQLite (default) or a local Postgres, with a
+fixture currency provider instead of forex, seeds a synthetic catalog and
+drives every route in app.py:
+
+    python benchmarks/bench_routes.py                              # sequential
+    python benchmarks/bench_routes.py --concurrency 8              # + concurrent mixed load
+    python benchmarks/bench_routes.py --url postgresql:///shop_bench --products 50000 --out before.json
+
+Prints (or writes with --out) a JSON report with p50/p95/p99 latency and
+throughput per route, so runs from two commits can be diffed. The
+concurrent mode also checks out a scarce product from every thread at once
+and reports whether it was ever oversold.
+
+The database at --url is dropped and rebuilt. Never point it at real data.'''
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy as sa
+
+from app import create_app
+from convert import Convert, FixtureProvider
+from models import db, User, Product, OrderProduct
+from passwords import passwords
+import migrations
+
+PASSWORD = 'bench123'
+RATES = {'MXN': 17.05, 'CAD': 1.35}
+LOCATIONS = ['USA', 'Canada', 'Mexico']
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def summarize(samples, wall):
+    ms = [s * 1000 for s in samples]
+    return {'requests': len(ms),
+            'p50_ms': round(percentile(ms, 50), 3),
+            'p95_ms': round(percentile(ms, 95), 3),
+            'p99_ms': round(percentile(ms, 99), 3),
+            'mean_ms': round(statistics.mean(ms), 3),
+            'throughput_rps': round(len(ms) / wall, 1) if wall else None}
+
+
+def build_app(url):
+    options = {'connect_args': {'timeout': 30}} if url.startswith('sqlite') else {}
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': url,
+        'SQLALCHEMY_ENGINE_OPTIONS': options,
+        'WTF_CSRF_ENABLED': False,
+        'THROTTLE_USER': '1000000/1',
+        'THROTTLE_IP': '1000000/1',
+    })
+    Convert.set_provider(FixtureProvider(RATES))
+    return app
+
+
+def seed(app, n_products, n_users, hot_stock):
+    '''Synthetic catalog plus users; product 1 is the scarce "hot" product.'''
+
+    rnd = random.Random(1)
+    categories = [f"category-{i}" for i in range(max(1, n_products // 50))]
+
+    with app.app_context():
+        db.drop_all()
+        migrations.schema_migrations.drop(db.engine, checkfirst = True)
+        migrations.upgrade(db.engine, log = lambda line: None)
+
+        hashed = passwords.hash(PASSWORD)               # one hash shared by every bench user
+        db.session.execute(sa.insert(User), [
+            {'username': f"bench{i}", 'email': f"bench{i}@example.com", 'password': hashed,
+             'location': LOCATIONS[i % len(LOCATIONS)], 'address': 'bench street'}
+            for i in range(n_users)])
+        db.session.execute(sa.insert(Product), [
+            {'name': f"product-{i:06d}", 'category': rnd.choice(categories), 'weight': 100,
+             'description': 'synthetic', 'price_cents': rnd.randint(100, 5000),
+             'quantity': hot_stock if i == 0 else 1_000_000, 'version': 1, 'image_url': ''}
+            for i in range(n_products)])
+        db.session.commit()
+
+        user_ids = [u.id for u in User.query.order_by(User.id)]
+        product_ids = [p for (p,) in db.session.query(Product.id).order_by(Product.id)]
+
+    return user_ids, product_ids, categories
+
+
+def login(app, username):
+    client = app.test_client()
+    response = client.post('/login', data = {'username': username, 'password': PASSWORD})
+    assert response.status_code == 302, f"login failed for {username}"
+    return client
+
+
+def scenario(user_id, product_ids, categories, rnd):
+    '''(route name, method, url, form) for one pass over every route.'''
+
+    product = rnd.choice(product_ids[1:])
+    return [
+        ('homepage', 'GET', '/', None),
+        ('categories', 'GET', '/categories', None),
+        ('category page', 'GET', f"/categories/{rnd.choice(categories)}", None),
+        ('product detail', 'GET', f"/products/{product}", None),
+        ('add to cart', 'POST', f"/products/{product}", {'quantity': 1}),
+        ('cart', 'GET', '/cart', None),
+        ('checkout', 'POST', '/cart', {}),
+        ('order history', 'GET', f"/users/{user_id}/orders", None),
+    ]
+
+
+def drive(client, steps, results, errors):
+    for name, method, url, form in steps:
+        start = time.perf_counter()
+        response = client.open(url, method = method, data = form)
+        elapsed = time.perf_counter() - start
+
+        if response.status_code >= 400:
+            errors[name] += 1
+        results[name].append(elapsed)
+
+
+def run_sequential(app, users, product_ids, categories, rounds):
+    rnd = random.Random(2)
+    client = login(app, f"bench{users[0][1]}")
+    results, errors = defaultdict(list), defaultdict(int)
+
+    drive(client, scenario(users[0][0], product_ids, categories, rnd), defaultdict(list), defaultdict(int))
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        drive(client, scenario(users[0][0], product_ids, categories, rnd), results, errors)
+    wall = time.perf_counter() - start
+
+    return {name: {**summarize(samples, sum(samples)), 'errors': errors[name]}
+            for name, samples in results.items()}, wall
+
+
+def run_concurrent(app, users, product_ids, categories, rounds, concurrency):
+    results, errors = defaultdict(list), defaultdict(int)
+    lock = threading.Lock()
+    clients = [login(app, f"bench{index}") for _, index in users[:concurrency]]
+
+    def worker(n):
+        rnd = random.Random(100 + n)
+        mine, my_errors = defaultdict(list), defaultdict(int)
+        for _ in range(rounds):
+            drive(clients[n], scenario(users[n][0], product_ids, categories, rnd), mine, my_errors)
+        with lock:
+            for name, samples in mine.items():
+                results[name] += samples
+            for name, count in my_errors.items():
+                errors[name] += count
+
+    threads = [threading.Thread(target = worker, args = (n,)) for n in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    routes = {name: {**summarize(samples, wall), 'errors': errors[name]}
+              for name, samples in results.items()}
+    total = sum(len(s) for s in results.values())
+    return routes, {'requests': total, 'wall_s': round(wall, 3), 'throughput_rps': round(total / wall, 1)}
+
+
+def run_oversell_check(app, users, hot_id, hot_stock, concurrency):
+    '''Every thread repeatedly puts the hot product in its cart and checks
+    out at the same time. Stock must end at >= 0 and match what was sold.'''
+
+    clients = [login(app, f"bench{index}") for _, index in users[:concurrency]]
+    barrier = threading.Barrier(concurrency)
+
+    def worker(n):
+        barrier.wait()
+        for _ in range(hot_stock):
+            clients[n].post(f"/products/{hot_id}", data = {'quantity': 1})
+            clients[n].post('/cart', data = {})
+
+    threads = [threading.Thread(target = worker, args = (n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with app.app_context():
+        remaining = db.session.get(Product, hot_id).quantity
+        sold = (db.session.query(sa.func.coalesce(sa.func.sum(OrderProduct.quantity), 0))
+                .filter(OrderProduct.product_id == hot_id).scalar())
+
+    return {'stock': hot_stock, 'sold': sold, 'remaining': remaining,
+            'oversold': remaining < 0 or sold + remaining != hot_stock}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default = os.environ.get('BENCH_DATABASE_URL', 'sqlite:////tmp/shop_routes_bench.db'))
+    parser.add_argument('--products', type = int, default = 5000)
+    parser.add_argument('--users', type = int, default = 50)
+    parser.add_argument('--rounds', type = int, default = 50, help = 'passes over every route per client')
+    parser.add_argument('--concurrency', type = int, default = 0, help = 'threads for the concurrent mode (0 = off)')
+    parser.add_argument('--hot-stock', type = int, default = 20)
+    parser.add_argument('--out', help = 'write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    passwords.rounds = 4                                # login cost is not what this measures
+    app = build_app(args.url)
+    user_ids, product_ids, categories = seed(app, args.products, max(args.users, args.concurrency + 1), args.hot_stock)
+    users = [(uid, i) for i, uid in enumerate(user_ids)]
+
+    report = {'url': sa.engine.make_url(args.url).render_as_string(hide_password = True),
+              'products': args.products, 'rounds': args.rounds}
+
+    report['sequential'], _ = run_sequential(app, users[-1:], product_ids, categories, args.rounds)
+
+    if args.concurrency:
+        routes, overall = run_concurrent(app, users, product_ids, categories, args.rounds, args.concurrency)
+        report['concurrent'] = {'threads': args.concurrency, 'overall': overall, 'routes': routes}
+        report['oversell_check'] = run_oversell_check(app, users, product_ids[0], args.hot_stock, args.concurrency)
+
+    text = json.dumps(report, indent = 2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if report.get('oversell_check', {}).get('oversold'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
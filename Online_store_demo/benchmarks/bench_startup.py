@@ -0,0 +1,61 @@
+'''Cold start of a worker: `import app` plus `create_app()`, each run in a
+fresh interpreter so nothing is cached in-process.
+
+    python benchmarks/bench_startup.py --runs 10 --max-ms 1500
+
+Prints a JSON report. With --max-ms it exits non-zero when the median
+total is above the budget, which is how CI tracks it.'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = '''
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "create_app_ms": (created - imported) * 1000}))
+'''
+
+
+def run_once(env):
+    out = subprocess.run([sys.executable, '-c', PROBE], cwd = HERE, env = env,
+                         capture_output = True, text = True, check = True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type = int, default = 10)
+    parser.add_argument('--max-ms', type = float, default = None,
+                        help = 'fail if the median import + create_app time is above this')
+    args = parser.parse_args()
+
+    # create_app must not touch the database: a file that can't be opened proves it.
+    env = dict(os.environ, DATABASE_URL = 'sqlite:////nonexistent/startup-probe.db')
+
+    run_once(env)                                       # warm the .pyc files, not measured
+    runs = [run_once(env) for _ in range(args.runs)]
+
+    report = {key: round(statistics.median(r[key] for r in runs), 1)
+              for key in ('import_ms', 'create_app_ms')}
+    report['total_ms'] = round(statistics.median(r['import_ms'] + r['create_app_ms'] for r in runs), 1)
+    report['runs'] = args.runs
+    print(json.dumps(report, indent = 2))
+
+    if args.max_ms is not None and report['total_ms'] > args.max_ms:
+        print(f"cold start {report['total_ms']}ms is over the {args.max_ms}ms budget", file = sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
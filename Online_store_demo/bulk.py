@@ -0,0 +1,349 @@
+'''Streaming product import and export (`flask products-import` / `products-export`).
+
+Files are CSV, JSON Lines or a JSON list of objects with the columns in
+FIELDS; `price` is in dollars ("3.25"), or give `price_cents` instead. Rows
+are read, written and sent to the database one batch at a time, so memory
+stays flat however big the file is. The exception is reading a JSON list,
+which is parsed whole; use JSON Lines for very large files.
+
+An import upserts by product name (the name is unique): new names are
+inserted, existing products get the file's values and a new version. The
+whole import is one transaction and bumps the catalog version once, so
+caches are invalidated a single time and a bad row leaves nothing behind.
+Postgres batches go through COPY into a temporary table, other databases
+use executemany with ON CONFLICT.
+
+update_stock() applies a list of stock and price changes (a delivery, a
+price list) to existing products with a single UPDATE.'''
+
+import csv
+import io
+import json
+import time
+from decimal import InvalidOperation
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+
+from fragments import cards
+from models import db, Product, CatalogVersion
+from pricing import to_minor, format_minor
+
+INT_MAX = 2 ** 31 - 1                                   # id, quantity and price_cents are 32-bit INTEGER columns
+
+FIELDS = ('name', 'category', 'weight', 'description', 'price', 'quantity', 'image_url')
+COLUMNS = ('name', 'category', 'weight', 'description', 'price_cents', 'quantity', 'image_url')
+
+
+def guess_format(path):
+    '''csv, jsonl or json from a file name, csv for stdin.'''
+
+    if path.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    return 'json' if path.endswith('.json') else 'csv'
+
+
+def read_rows(stream, fmt):
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    elif fmt == 'json':
+        rows = json.load(stream)
+        if not isinstance(rows, list):
+            raise ValueError("expected a JSON list of rows")
+        yield from rows
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def product_row(raw, line):
+    '''One file row -> values for the products columns.'''
+
+    try:
+        if raw.get('price_cents') not in (None, ''):
+            price_cents = int(raw['price_cents'])
+        else:
+            price_cents = to_minor(raw['price'])
+
+        row = {'name': raw['name'].strip(),
+               'category': raw['category'].strip(),
+               'weight': int(raw['weight']),
+               'description': raw.get('description') or '',
+               'price_cents': price_cents,
+               'quantity': int(raw['quantity']),
+               'image_url': raw.get('image_url') or None}
+    except KeyError as e:
+        raise ValueError(f"row {line}: missing {e.args[0]}")
+    except (AttributeError, TypeError, ValueError, InvalidOperation) as e:
+        raise ValueError(f"row {line}: {e}")
+
+    if not row['name']:
+        raise ValueError(f"row {line}: empty name")
+    if row['price_cents'] < 0 or row['quantity'] < 0:
+        raise ValueError(f"row {line}: negative price or quantity")
+    return row
+
+
+def batches(rows, size):
+    '''Lists of up to `size` validated rows. A name repeated within a batch
+    keeps its last row, as it would if the rows were applied one by one.'''
+
+    batch = {}
+    for line, raw in enumerate(rows, start = 1):
+        row = product_row(raw, line)
+        batch.pop(row['name'], None)
+        batch[row['name']] = row
+        if len(batch) >= size:
+            yield list(batch.values())
+            batch = {}
+    if batch:
+        yield list(batch.values())
+
+
+class ExecutemanyLoader():
+    '''INSERT ... ON CONFLICT (name) DO UPDATE, one executemany per batch.'''
+
+    def __init__(self, conn):
+        self.conn = conn
+        table = Product.__table__
+        insert = postgresql.insert if conn.dialect.name == 'postgresql' else sqlite.insert
+        stmt = insert(table)
+        updates = {c: stmt.excluded[c] for c in COLUMNS if c != 'name'}
+        updates['version'] = table.c.version + 1
+        self.stmt = stmt.on_conflict_do_update(index_elements = ['name'], set_ = updates)
+
+    def load(self, rows):
+        self.conn.execute(self.stmt, [dict(row, version = 1) for row in rows])
+
+
+class CopyLoader():
+    '''Postgres: COPY each batch into a temporary table, then upsert it
+    into products with one INSERT ... SELECT.'''
+
+    def __init__(self, conn):
+        self.conn = conn
+        conn.execute(sa.text('''
+            CREATE TEMPORARY TABLE products_import (
+                name text, category text, weight integer, description text,
+                price_cents integer, quantity integer, image_url text
+            ) ON COMMIT DROP'''))
+
+        columns = ', '.join(COLUMNS)
+        updates = ', '.join(f"{c} = excluded.{c}" for c in COLUMNS if c != 'name')
+        self.merge = sa.text(f'''
+            INSERT INTO products ({columns}, version)
+            SELECT {columns}, 1 FROM products_import
+            ON CONFLICT (name) DO UPDATE SET {updates}, version = products.version + 1''')
+        self.copy = f"COPY products_import ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+    def load(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(['\\N' if row[c] is None else row[c] for c in COLUMNS])
+        buffer.seek(0)
+
+        self.conn.execute(sa.text("TRUNCATE products_import"))
+        with self.conn.connection.dbapi_connection.cursor() as cursor:
+            cursor.copy_expert(self.copy, buffer)
+        self.conn.execute(self.merge)
+
+
+def import_products(stream, fmt = 'csv', batch_size = 1000):
+    '''Upsert every product in `stream`. Returns (rows, seconds).
+
+    Raises ValueError (naming the row) on bad input; nothing is written then.'''
+
+    start = time.perf_counter()
+    conn = db.session.connection()
+    loader = CopyLoader(conn) if conn.dialect.name == 'postgresql' else ExecutemanyLoader(conn)
+    count = 0
+
+    try:
+        for batch in batches(read_rows(stream, fmt), batch_size):
+            loader.load(batch)
+            count += len(batch)
+
+        CatalogVersion.bump()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return count, time.perf_counter() - start
+
+
+def export_products(stream, fmt = 'csv', batch_size = 1000):
+    '''Write every product to `stream` in id order. Returns (rows, seconds).'''
+
+    start = time.perf_counter()
+    table = Product.__table__
+    query = (sa.select(*[table.c[c] for c in COLUMNS])
+               .order_by(table.c.id)
+               .execution_options(yield_per = batch_size))
+
+    writer = None
+    if fmt == 'csv':
+        writer = csv.DictWriter(stream, fieldnames = FIELDS)
+        writer.writeheader()
+
+    count = 0
+    for row in db.session.execute(query).mappings():
+        out = {f: row[f] for f in FIELDS if f != 'price'}
+        out['price'] = format_minor(row['price_cents'])
+
+        if writer is not None:
+            writer.writerow(out)
+        elif fmt == 'json':
+            stream.write(('[\n' if count == 0 else ',\n') + json.dumps(out))
+        else:
+            stream.write(json.dumps(out) + '\n')
+        count += 1
+
+    if fmt == 'json':
+        stream.write('\n]\n' if count else '[]\n')
+
+    return count, time.perf_counter() - start
+
+
+def present(item, key):
+    return item.get(key) not in (None, '')
+
+
+def in_range(key, value):
+    if not -INT_MAX <= value <= INT_MAX:
+        raise ValueError(f"{key} is out of range")
+    return value
+
+
+def whole_number(item, key):
+    try:
+        value = int(item[key])
+    except (TypeError, ValueError):
+        raise ValueError(f"{key} must be a whole number")
+    return in_range(key, value)
+
+
+def dollars(item, key):
+    try:
+        value = to_minor(item[key])
+    except (TypeError, ValueError, InvalidOperation):
+        raise ValueError(f"{key} must be a number")
+    return in_range(key, value)
+
+
+def parse_update(item):
+    '''Validated change from one input item, or raises ValueError.
+
+    An item names its product by `id` or `name` and sets any of `quantity`
+    (absolute), `quantity_delta` (added to stock) and `price` (dollars) or
+    `price_cents`.'''
+
+    if not isinstance(item, dict):
+        raise ValueError("expected an object")
+
+    change = {}
+    if present(item, 'id'):
+        change['id'] = whole_number(item, 'id')
+    elif present(item, 'name'):
+        change['name'] = str(item['name']).strip()
+    else:
+        raise ValueError("needs an id or a name")
+
+    if present(item, 'quantity') and present(item, 'quantity_delta'):
+        raise ValueError("give quantity or quantity_delta, not both")
+    if present(item, 'quantity'):
+        change['quantity'] = whole_number(item, 'quantity')
+    if present(item, 'quantity_delta'):
+        change['quantity_delta'] = whole_number(item, 'quantity_delta')
+
+    if present(item, 'price_cents'):
+        change['price_cents'] = whole_number(item, 'price_cents')
+    elif present(item, 'price'):
+        change['price_cents'] = dollars(item, 'price')
+
+    if len(change) == 1:
+        raise ValueError("nothing to change")
+    if change.get('quantity', 0) < 0 or change.get('price_cents', 0) < 0:
+        raise ValueError("quantity and price can't be negative")
+    return change
+
+
+def update_stock(items):
+    '''Apply stock and price changes to existing products in one transaction.
+
+    The products are read (and locked, where the database can) with one
+    SELECT and written with one UPDATE whose CASE expressions carry every
+    row's new values; the catalog version is bumped once. Items that fail
+    validation, name a missing product or would take stock below zero are
+    skipped. Changes to the same product apply in order.
+
+    Returns one result dict per item, in input order: {'status': 'updated'
+    | 'invalid' | 'not_found' | 'rejected', ...}.'''
+
+    results, changes = [], []
+    for n, item in enumerate(items):
+        try:
+            changes.append((n, parse_update(item)))
+            results.append(None)
+        except ValueError as e:
+            results.append({'item': n, 'status': 'invalid', 'error': str(e)})
+
+    ids = {c['id'] for _, c in changes if 'id' in c}
+    names = {c['name'] for _, c in changes if 'name' in c}
+
+    found = (db.session.query(Product.id, Product.name, Product.quantity, Product.price_cents)
+             .filter(sa.or_(Product.id.in_(ids), Product.name.in_(names)))
+             .with_for_update()
+             .all()) if changes else []
+    by_id = {p.id: p for p in found}
+    by_name = {p.name: p for p in found}
+
+    new = {}                                            # product id -> {'quantity', 'price_cents'}
+    for n, change in changes:
+        product = by_id.get(change['id']) if 'id' in change else by_name.get(change['name'])
+        if product is None:
+            results[n] = {'item': n, 'status': 'not_found'}
+            continue
+
+        values = new.get(product.id) or {'quantity': product.quantity, 'price_cents': product.price_cents}
+        quantity = change.get('quantity', values['quantity']) + change.get('quantity_delta', 0)
+
+        if quantity < 0:
+            results[n] = {'item': n, 'id': product.id, 'name': product.name, 'status': 'rejected',
+                          'error': f"only {values['quantity']} in stock"}
+            continue
+        if quantity > INT_MAX:
+            results[n] = {'item': n, 'id': product.id, 'name': product.name, 'status': 'rejected',
+                          'error': f"stock can't go above {INT_MAX}"}
+            continue
+
+        new[product.id] = {'quantity': quantity,
+                           'price_cents': change.get('price_cents', values['price_cents'])}
+        results[n] = {'item': n, 'id': product.id, 'name': product.name, 'status': 'updated'}
+
+    try:
+        if new:
+            db.session.execute(
+                sa.update(Product.__table__)
+                  .where(Product.__table__.c.id.in_(new))
+                  .values(quantity = sa.case({i: v['quantity'] for i, v in new.items()},
+                                             value = Product.__table__.c.id),
+                          price_cents = sa.case({i: v['price_cents'] for i, v in new.items()},
+                                                value = Product.__table__.c.id),
+                          version = Product.__table__.c.version + 1))
+            CatalogVersion.bump()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    for product_id in new:
+        cards.drop_product(product_id)
+
+    for result in results:
+        if result['status'] == 'updated':
+            result.update(quantity = new[result['id']]['quantity'],
+                          price = format_minor(new[result['id']]['price_cents']))
+    return results
@@ -0,0 +1,81 @@
+import hashlib
+import os
+
+from flask import make_response, request, session, current_app
+
+STATIC_MAX_AGE = 365 * 24 * 3600                        # fingerprinted files never change under the same URL
+
+
+class StaticFingerprints():
+    '''Content hashes of files under the static folder, computed once per file.'''
+
+    def __init__(self):
+        self._hashes = {}
+
+    def url(self, filename):
+        '''/static/<filename>?v=<hash>. The hash changes whenever the file does,
+        so the URL can be cached as immutable.'''
+
+        if filename not in self._hashes:
+            path = os.path.join(current_app.static_folder, filename)
+            try:
+                with open(path, 'rb') as f:
+                    self._hashes[filename] = hashlib.sha1(f.read()).hexdigest()[:10]
+            except OSError:
+                self._hashes[filename] = None
+
+        digest = self._hashes[filename]
+        url = f"{current_app.static_url_path}/{filename}"
+        return f"{url}?v={digest}" if digest else url
+
+
+fingerprints = StaticFingerprints()
+
+
+def page_etag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def cached_page(render, *parts):
+    '''Answer 304 Not Modified if the browser already has the page described
+    by `parts`, otherwise call `render()`. Either way the response carries a
+    weak ETag built from `parts` and the full request path.
+
+    Pages with pending flash messages are always rendered.'''
+
+    if '_flashes' in session:
+        return render()
+
+    etag = page_etag(request.full_path, *parts)
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status = 304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag, weak = True)
+    return response
+
+
+def cache_headers(response):
+    '''Cache-Control for every response.
+
+    Fingerprinted static files are immutable for a year, other static files
+    for an hour. Pages with an ETag may be kept by the browser but are
+    revalidated on each use; everything else is not stored.'''
+
+    if request.path.startswith(current_app.static_url_path + '/'):
+        if request.args.get('v'):
+            response.headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE}, immutable'
+        else:
+            response.headers['Cache-Control'] = 'public, max-age=3600'
+
+    elif response.headers.get('ETag'):
+        response.headers['Cache-Control'] = 'private, no-cache'
+
+    else:
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
+
+    return response
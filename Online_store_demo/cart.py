@@ -0,0 +1,56 @@
+class Cart():
+    '''Shopping cart keyed by product id.
+
+    Lines keep the order they were added in. add/update/remove are single
+    dict operations.'''
+
+    def __init__(self, lines = None):
+        self.lines = dict(lines or {})                  # product_id -> quantity
+
+    @classmethod
+    def from_session(cls, data):
+        '''Build a cart from the lines an old session held: [product_id,
+        quantity] pairs, or the older {'product_id', 'quantity'} dicts.'''
+
+        cart = cls()
+        for line in data or []:
+            if isinstance(line, dict):
+                cart.add(line.get('product_id'), line.get('quantity'))
+            else:
+                cart.add(*line)
+        return cart
+
+    def add(self, product_id, quantity):
+        '''Put `quantity` of a product in the cart, replacing any earlier line
+        for it. Returns True if an earlier line was replaced.'''
+
+        replaced = self.lines.pop(product_id, None) is not None
+        self.lines[product_id] = quantity
+        return replaced
+
+    def update(self, product_id, quantity):
+        '''Change the quantity of a line already in the cart, in place.'''
+
+        if product_id in self.lines:
+            self.lines[product_id] = quantity
+
+    def remove(self, product_id):
+        self.lines.pop(product_id, None)
+
+    def merge(self, other):
+        '''Add the lines of `other` to this cart, summing quantities.'''
+
+        for product_id, quantity in other.items():
+            self.lines[product_id] = self.lines.get(product_id, 0) + quantity
+
+    def items(self):
+        return self.lines.items()
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __contains__(self, product_id):
+        return product_id in self.lines
@@ -0,0 +1,110 @@
+import threading
+import uuid
+
+from sqlalchemy.exc import IntegrityError
+
+from cart import Cart
+from models import db, StoredCart, CartLine
+
+
+class MemoryCartStore():
+    '''Carts held in this process. For tests and single process runs.'''
+
+    def __init__(self):
+        self._carts = {}                                # cart_id -> Cart
+        self._users = {}                                # user_id -> cart_id
+        self._lock = threading.Lock()
+
+    def for_user(self, user_id):
+        with self._lock:
+            if user_id not in self._users:
+                self._users[user_id] = uuid.uuid4().hex
+                self._carts[self._users[user_id]] = Cart()
+            return self._users[user_id]
+
+    def load(self, cart_id):
+        with self._lock:
+            return Cart(self._carts.get(cart_id, Cart()).items())
+
+    def set_line(self, cart_id, product_id, quantity):
+        with self._lock:
+            return self._carts.setdefault(cart_id, Cart()).add(product_id, quantity)
+
+    def remove_line(self, cart_id, product_id):
+        with self._lock:
+            self._carts.get(cart_id, Cart()).remove(product_id)
+
+    def clear(self, cart_id):
+        with self._lock:
+            self._carts[cart_id] = Cart()
+
+
+class DBCartStore():
+    '''Carts in the carts / cart_lines tables, shared by every worker.
+
+    Every change is a single statement on one line, so two tabs adding
+    to the same cart can't overwrite each other's lines.'''
+
+    def for_user(self, user_id):
+        '''Id of the user's cart, created on first use.'''
+
+        cart = StoredCart.query.filter_by(user_id = user_id).first()
+        if cart:
+            return cart.id
+
+        cart = StoredCart(id = uuid.uuid4().hex, user_id = user_id)
+        db.session.add(cart)
+        try:
+            db.session.commit()
+        except IntegrityError:                          # another request created it first
+            db.session.rollback()
+            cart = StoredCart.query.filter_by(user_id = user_id).one()
+        return cart.id
+
+    def load(self, cart_id):
+        lines = (db.session
+                 .query(CartLine.product_id, CartLine.quantity)
+                 .filter(CartLine.cart_id == cart_id)
+                 .order_by(CartLine.added_at, CartLine.product_id))
+        return Cart(lines)
+
+    def set_line(self, cart_id, product_id, quantity):
+        '''Upsert one line. Returns True if the product was already in the cart.'''
+
+        updated = db.session.execute(
+            db.update(CartLine)
+              .where(CartLine.cart_id == cart_id, CartLine.product_id == product_id)
+              .values(quantity = quantity)
+        ).rowcount
+
+        if not updated:
+            db.session.add(CartLine(cart_id = cart_id, product_id = product_id, quantity = quantity))
+        try:
+            db.session.commit()
+        except IntegrityError:                          # lost an insert race, the line exists now
+            db.session.rollback()
+            db.session.execute(
+                db.update(CartLine)
+                  .where(CartLine.cart_id == cart_id, CartLine.product_id == product_id)
+                  .values(quantity = quantity)
+            )
+            db.session.commit()
+            return True
+        return bool(updated)
+
+    def remove_line(self, cart_id, product_id):
+        db.session.execute(
+            db.delete(CartLine)
+              .where(CartLine.cart_id == cart_id, CartLine.product_id == product_id)
+        )
+        db.session.commit()
+
+    def clear(self, cart_id):
+        db.session.execute(db.delete(CartLine).where(CartLine.cart_id == cart_id))
+        db.session.commit()
+
+
+def make_cart_store(kind):
+    '''CART_STORE=db (default) or memory.'''
+
+    return MemoryCartStore() if kind == 'memory' else DBCartStore()
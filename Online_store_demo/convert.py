@@ -1,27 +1,208 @@
-from forex_python.converter import CurrencyRates
-
-class Convert():
-
-    def __init__(self):
-        self.c = CurrencyRates()
-    
-    @classmethod
-    def check(cls, location):
-        
-        conv_to = 'USD'
-
-        if location == 'Mexico':
-            conv_to = 'MXN'
-        if location == 'Canada':
-            conv_to = 'CAD'
-
-        conv_to = conv_to.upper()
-
-        rate = CurrencyRates().convert('USD', conv_to, 1)
-        rate = round(rate, 2)
-
-        currency = {'label': conv_to,
-                    'rate' : rate
-                }
-        return currency
-    
\ No newline at end of file
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from models import db, CurrencyRate, LocationCurrency
+import instrumentation
+
+log = logging.getLogger(__name__)
+
+
+class ForexProvider():
+    '''Live rates from forex_python. Imported lazily so offline runs
+        and tests that use a fixture never need the package.'''
+
+    def __init__(self):
+        from forex_python.converter import CurrencyRates
+        self.c = CurrencyRates()
+
+    def rate(self, base, conv_to):
+        return self.c.convert(base, conv_to, 1)
+
+
+class FixtureProvider():
+    '''Rates from a local dict, e.g. {'MXN': 17.05, 'CAD': 1.35}.
+        Used by tests and offline runs instead of forex_python.'''
+
+    def __init__(self, rates):
+        self.rates = dict(rates)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def rate(self, base, conv_to):
+        if conv_to == base:
+            return 1
+        return self.rates[conv_to]
+
+
+class RateCache():
+    '''Rates keyed by target currency, kept for `ttl` seconds.
+
+        Only one caller refreshes a given currency at a time. While it does,
+        everyone else gets the stale rate instead of waiting on the network.
+        A caller only blocks when there is no rate cached at all yet.'''
+
+    def __init__(self, provider, ttl = 600):
+        self.provider = provider
+        self.ttl = ttl
+        self._rates = {}                                # conv_to -> (rate, fetched_at)
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def _lock_for(self, conv_to):
+        with self._guard:
+            return self._locks.setdefault(conv_to, threading.Lock())
+
+    def _fresh(self, entry):
+        return entry is not None and time.monotonic() - entry[1] < self.ttl
+
+    def get(self, base, conv_to):
+        entry = self._rates.get(conv_to)
+        if self._fresh(entry):
+            return entry[0]
+
+        lock = self._lock_for(conv_to)
+
+        if entry is not None:                           # stale: refresh only if nobody else is
+            if not lock.acquire(blocking = False):
+                return entry[0]
+        else:
+            lock.acquire()                              # cold: wait for whoever is fetching
+
+        try:
+            entry = self._rates.get(conv_to)
+            if self._fresh(entry):
+                return entry[0]
+
+            start = time.perf_counter()
+            try:
+                rate = self.provider.rate(base, conv_to)
+            except Exception:
+                if entry is not None:                   # provider down: keep serving last known rate
+                    return entry[0]
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                instrumentation.rate_fetch_seconds.observe(elapsed, currency = conv_to,
+                                                           provider = type(self.provider).__name__)
+                instrumentation.record('rates', elapsed)
+
+            self._rates[conv_to] = (rate, time.monotonic())
+            return rate
+        finally:
+            lock.release()
+
+    def clear(self):
+        self._rates.clear()
+
+
+class SnapshotProvider():
+    '''Latest rate snapshot from the currency_rates table.
+
+        Request handlers only do this indexed lookup. The upstream provider
+        (forex or fixture) is only called when a currency has no snapshot
+        at all yet, e.g. right after a fresh install. A snapshot older than
+        `max_age` seconds is still served, with a warning in the log: the
+        refresher (`flask refresh-rates --every N`) has stopped.'''
+
+    def __init__(self, upstream = None, max_age = 86400):
+        self.upstream = upstream
+        self.max_age = max_age
+
+    def rate(self, base, conv_to):
+        snapshot = CurrencyRate.latest(conv_to)
+
+        if snapshot is not None and datetime.utcnow() - snapshot.fetched_at > timedelta(seconds = self.max_age):
+            log.warning("%s rate is from %s; is `flask refresh-rates` running?", conv_to, snapshot.fetched_at)
+
+        if snapshot is None:
+            if self.upstream is None:
+                self.upstream = default_provider()
+            snapshot = CurrencyRate.add(conv_to, self.upstream.rate(base, conv_to))
+
+        return {'rate': snapshot.rate, 'rate_id': snapshot.id}
+
+
+def default_provider():
+    '''RATES_FIXTURE=path/to/rates.json switches to offline rates.'''
+
+    path = os.environ.get('RATES_FIXTURE')
+    return FixtureProvider.from_file(path) if path else ForexProvider()
+
+
+def refresh_rates(provider = None):
+    '''Store a fresh snapshot for every currency in location_currencies.
+        Run periodically by `flask refresh-rates`.
+
+        A currency the provider fails on keeps its last snapshot; the others
+        are still stored. Returns (snapshots stored, {label: error}).'''
+
+    provider = provider or default_provider()
+    labels = {c for (c,) in db.session.query(LocationCurrency.currency).distinct()}
+    labels.discard(Convert.base)
+
+    snapshots, failed = [], {}
+    for label in sorted(labels):
+        try:
+            snapshots.append(CurrencyRate(label = label, rate = provider.rate(Convert.base, label)))
+        except Exception as e:
+            log.warning("fetching the %s rate failed: %s", label, e)
+            failed[label] = f"{type(e).__name__}: {e}"
+
+    db.session.add_all(snapshots)
+    db.session.commit()
+    Convert.rates.clear()
+    return snapshots, failed
+
+
+class Convert():
+
+    base = 'USD'
+    ttl = int(os.environ.get('RATE_TTL', 600))
+    rates = RateCache(provider = SnapshotProvider(max_age = int(os.environ.get('RATE_MAX_AGE', 86400))), ttl = ttl)
+
+    _locations = {}                                     # location -> currency label
+    _locations_at = None
+
+    @classmethod
+    def set_provider(cls, provider):
+        '''Swap the rate source (e.g. FixtureProvider in tests) and drop cached rates.'''
+
+        cls.rates.provider = provider
+        cls.rates.clear()
+
+    @classmethod
+    def currency_for(cls, location):
+        '''Currency label for `location` from the location_currencies table.
+            The (small) table is reloaded at most once per TTL.'''
+
+        now = time.monotonic()
+        if cls._locations_at is None or now - cls._locations_at >= cls.ttl:
+            cls._locations = {l.location: l.currency for l in LocationCurrency.query.all()}
+            cls._locations_at = now
+
+        return cls._locations.get(location, cls.base).upper()
+
+    @classmethod
+    def check(cls, location):
+
+        conv_to = cls.currency_for(location)
+
+        if conv_to == cls.base:
+            return {'label': conv_to, 'rate': 1, 'rate_id': None}
+
+        snapshot = cls.rates.get(cls.base, conv_to)
+        if not isinstance(snapshot, dict):              # plain providers return a bare rate
+            snapshot = {'rate': snapshot, 'rate_id': None}
+
+        currency = {'label': conv_to,
+                    'rate' : round(snapshot['rate'], 2),
+                    'rate_id': snapshot['rate_id']
+                }
+        return currency
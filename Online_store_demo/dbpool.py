@@ -0,0 +1,83 @@
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+from metrics import registry
+
+checkout_wait = registry.histogram('db_pool_checkout_wait_seconds',
+                                   'Time spent waiting for a pooled DB connection.')
+checkout_timeouts = registry.counter('db_pool_checkout_timeouts_total',
+                                     'Checkouts that gave up after DB_POOL_TIMEOUT.')
+
+
+class TimedQueuePool(QueuePool):
+    '''QueuePool that records how long each checkout waited.'''
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            checkout_timeouts.inc()
+            raise
+        finally:
+            checkout_wait.observe(time.perf_counter() - start)
+
+
+def flag(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
+def engine_options(environ, uri):
+    '''SQLALCHEMY_ENGINE_OPTIONS from the environment.
+
+        DB_POOL_MODE      queue (default) or transaction. Use transaction
+                          behind PgBouncer in transaction pooling mode: the
+                          bouncer pools, so every checkout opens and closes.
+        DB_POOL_SIZE      connections kept open per worker (5)
+        DB_MAX_OVERFLOW   extra connections allowed under load (5)
+        DB_POOL_TIMEOUT   seconds to wait for a connection (10)
+        DB_POOL_RECYCLE   reopen connections older than this, seconds (1800)
+        DB_POOL_PRE_PING  test connections on checkout (true)
+
+    SQLite keeps SQLAlchemy's defaults.'''
+
+    if uri.startswith('sqlite'):
+        return {}
+
+    if environ.get('DB_POOL_MODE', 'queue') == 'transaction':
+        return {'poolclass': NullPool}
+
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(environ.get('DB_MAX_OVERFLOW', 5)),
+        'pool_timeout': float(environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': flag(environ.get('DB_POOL_PRE_PING', 'true')),
+    }
+
+
+def register_pool_gauges(get_engine):
+    '''Pool size, checked out connections, overflow and saturation, read from
+    the engine returned by `get_engine()` at scrape time.'''
+
+    def pool():
+        pool = get_engine().pool
+        return pool if isinstance(pool, QueuePool) else None
+
+    def read(fn):
+        def value():
+            p = pool()
+            return fn(p) if p is not None else {}
+        return value
+
+    registry.gauge('db_pool_size', 'Connections the pool keeps open.',
+                   read(lambda p: p.size()))
+    registry.gauge('db_pool_checked_out', 'Connections currently in use.',
+                   read(lambda p: p.checkedout()))
+    registry.gauge('db_pool_overflow', 'Connections open beyond pool size.',
+                   read(lambda p: max(p.overflow(), 0)))
+    registry.gauge('db_pool_saturation', 'Checked out / (size + max overflow).',
+                   read(lambda p: round(p.checkedout() / max(p.size() + p._max_overflow, 1), 3)))
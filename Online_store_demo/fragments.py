@@ -0,0 +1,49 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class FragmentCache():
+    '''LRU of rendered HTML fragments, capped at `max_bytes` of HTML.
+
+    Keys are tuples whose first item is the product id, so everything
+    cached for one product can be dropped at once.'''
+
+    def __init__(self, max_bytes = 8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()                   # key -> html
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+            return html
+
+    def set(self, key, html):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self._entries[key] = html
+            self.size += len(html)
+
+            while self.size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last = False)
+                self.size -= len(evicted)
+
+    def drop_product(self, product_id):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == product_id]:
+                self.size -= len(self._entries.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+cards = FragmentCache(max_bytes = int(os.environ.get('FRAGMENT_CACHE_BYTES', 8 * 1024 * 1024)))
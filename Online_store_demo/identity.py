@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class Identity():
+    '''What most requests need to know about the logged in user.
+
+    Anything else (orders, email, password hash...) loads the full
+    User row on first access.'''
+
+    def __init__(self, id, username, location, image_url, is_admin, loader = None):
+        self.id = id
+        self.username = username
+        self.location = location
+        self.image_url = image_url
+        self.is_admin = is_admin
+        self._loader = loader
+        self._user = None
+
+    @classmethod
+    def from_user(cls, user, is_admin, loader = None):
+        return cls(user.id, user.username, user.location, user.image_url, is_admin, loader)
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = self._loader(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    def __repr__(self):
+        return f"<Identity #{self.id}: {self.username}, {self.location}>"
+
+
+class IdentityCache():
+    '''Bounded LRU of identity snapshots keyed by user id.
+
+    invalidate() moves the user's version on, which also stops a lookup
+    that started before the change from caching what it read. Entries
+    expire after `ttl` seconds so edits made through another worker
+    show up here too.'''
+
+    def __init__(self, size = 1024, ttl = 60):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()                   # user_id -> (snapshot fields, version, stored_at)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id, load_user, is_admin, loader = None):
+        '''Identity for `user_id`, or None if the user no longer exists.
+
+        `load_user(user_id)` is only called on a miss.'''
+
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            version = self._versions.get(user_id, 0)
+            if entry and entry[1] == version and now - entry[2] < self.ttl:
+                self._entries.move_to_end(user_id)
+                return Identity(*entry[0], loader = loader)
+
+        user = load_user(user_id)
+        if user is None:
+            return None
+
+        identity = Identity.from_user(user, is_admin(user), loader)
+        identity._user = user
+
+        with self._lock:
+            if self._versions.get(user_id, 0) == version:
+                self._entries[user_id] = ((identity.id, identity.username, identity.location,
+                                           identity.image_url, identity.is_admin), version, now)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last = False)
+
+        return identity
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            for user_id in self._entries:
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._entries.clear()
+
+
+identities = IdentityCache(size = int(os.environ.get('IDENTITY_CACHE_SIZE', 1024)),
+                           ttl = int(os.environ.get('IDENTITY_TTL', 60)))
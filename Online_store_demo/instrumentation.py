@@ -0,0 +1,110 @@
+'''Where a request spends its time: the route as a whole, SQL, rate fetches,
+bcrypt and template rendering.
+
+Everything is recorded in the metrics registry (served at /metrics) and,
+for the current request, summed into a Server-Timing header, so a single
+slow page can be looked at in the browser's network tab.'''
+
+import time
+
+from flask import g, has_request_context, request, template_rendered, before_render_template
+from flask.signals import signals_available
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import registry
+
+request_seconds = registry.histogram('http_request_duration_seconds',
+                                     'Request latency by route, method and status.')
+sql_queries = registry.counter('db_queries_total', 'SQL statements executed, by route.')
+sql_seconds = registry.histogram('db_query_duration_seconds', 'SQL statement latency, by route.')
+rate_fetch_seconds = registry.histogram('rate_fetch_duration_seconds',
+                                        'Time spent fetching a currency rate from its provider.')
+bcrypt_seconds = registry.histogram('bcrypt_duration_seconds', 'Password hash and verify time.',
+                                    buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+render_seconds = registry.histogram('template_render_duration_seconds', 'Template render time.')
+
+PHASES = ('db', 'rates', 'bcrypt', 'render')            # Server-Timing entries besides "app"
+
+
+def route():
+    '''URL rule of the current request ("/products/<int:product_id>"), '' outside one.'''
+
+    if not has_request_context():
+        return ''
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def record(phase, seconds):
+    '''Add `seconds` to `phase` of the current request, if there is one.'''
+
+    if has_request_context() and 'timings' in g:
+        total = g.timings.setdefault(phase, [0, 0.0])   # [count, seconds]
+        total[0] += 1
+        total[1] += seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    name = route()
+    sql_queries.inc(route = name)
+    sql_seconds.observe(elapsed, route = name)
+    record('db', elapsed)
+
+
+def _before_render(sender, template, context, **extra):
+    if has_request_context():
+        g.setdefault('render_start', []).append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    if has_request_context() and g.get('render_start'):
+        elapsed = time.perf_counter() - g.render_start.pop()
+        render_seconds.observe(elapsed, template = template.name or '')
+        record('render', elapsed)
+
+
+def server_timing(total, timings):
+    '''Server-Timing value, e.g. app;dur=12.3, db;dur=4.1;desc="6 queries".'''
+
+    entries = [f"app;dur={total * 1000:.1f}"]
+    for phase in PHASES:
+        if phase in timings:
+            count, seconds = timings[phase]
+            desc = f'{count} queries' if phase == 'db' else f'{count} calls'
+            entries.append(f'{phase};dur={seconds * 1000:.1f};desc="{desc}"')
+    return ', '.join(entries)
+
+
+def init_app(app):
+    '''Time every request of `app`. The Server-Timing header is only added
+    with SERVER_TIMING = True; it tells any visitor how long the database,
+    rate and bcrypt work took, so it is off unless asked for.'''
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.timings = {}
+
+    @app.after_request
+    def stop_timer(response):
+        if 'request_start' not in g:
+            return response
+
+        total = time.perf_counter() - g.request_start
+        request_seconds.observe(total, route = route(), method = request.method,
+                                status = response.status_code)
+
+        if app.config.get('SERVER_TIMING', False):
+            response.headers['Server-Timing'] = server_timing(total, g.timings)
+        return response
+
+    if signals_available:                               # needs blinker
+        before_render_template.connect(_before_render, app)
+        template_rendered.connect(_rendered, app)
@@ -0,0 +1,216 @@
+'''Background jobs: a pluggable queue and the worker that drains it.
+
+Used by the async checkout (CHECKOUT_MODE=async): the request takes the
+stock and enqueues a 'checkout' job, `flask checkout-worker` finalizes
+the order. JOB_QUEUE picks the backend:
+
+    db      (default) the jobs table. Jobs commit with the order that made
+            them and survive restarts; any number of workers can drain it.
+    memory  this process only, drained by a worker thread the app starts
+            itself. For tests and single process runs.
+
+A job is retried with exponential backoff until it has run max_attempts
+times, then the handler's give-up function is called (for checkout: put
+the stock back and mark the order failed). Handlers must be safe to run
+twice for one job, because a worker can die between finishing a job and
+marking it done.'''
+
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from models import db, Job
+
+log = logging.getLogger(__name__)
+
+
+class QueuedJob():
+
+    def __init__(self, id, kind, payload, attempts = 0, run_after = 0.0):
+        self.id = id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+        self.run_after = run_after
+
+
+class MemoryJobQueue():
+    '''Jobs held in this process. For tests and single process runs.'''
+
+    transactional = False                               # enqueue after the order commits
+
+    def __init__(self):
+        self._jobs = deque()
+        self._ids = itertools.count(1)
+        self._ready = threading.Condition()
+        self.failed = []                                # (job, error), for inspection in tests
+
+    def enqueue(self, kind, payload):
+        with self._ready:
+            self._jobs.append(QueuedJob(next(self._ids), kind, payload))
+            self._ready.notify()
+
+    def claim(self, limit):
+        now = time.time()
+        with self._ready:
+            due = [j for j in self._jobs if j.run_after <= now][:limit]
+            for job in due:
+                self._jobs.remove(job)
+                job.attempts += 1
+            return due
+
+    def done(self, job):
+        pass
+
+    def retry(self, job, error, delay):
+        with self._ready:
+            job.run_after = time.time() + delay
+            self._jobs.append(job)
+
+    def fail(self, job, error):
+        self.failed.append((job, error))
+
+    def wait(self, timeout):
+        with self._ready:
+            self._ready.wait(timeout)
+
+    def __len__(self):
+        return len(self._jobs)
+
+
+class DBJobQueue():
+    '''Jobs in the jobs table, shared by every web and worker process.
+
+    enqueue() only adds the job to the session, so it commits (or rolls
+    back) together with whatever created it. A job left 'running' for
+    `stale_after` seconds belongs to a worker that died and is claimed
+    again.'''
+
+    transactional = True
+
+    def __init__(self, stale_after = 300):
+        self.stale_after = stale_after
+
+    def enqueue(self, kind, payload):
+        db.session.add(Job(kind = kind, payload = json.dumps(payload), run_after = time.time()))
+
+    def _claimable(self, now):
+        return db.or_(db.and_(Job.status == 'queued', Job.run_after <= now),
+                      db.and_(Job.status == 'running', Job.claimed_at < now - self.stale_after))
+
+    def claim(self, limit):
+        '''Up to `limit` due jobs, marked running. Postgres workers skip rows
+        another worker has locked; everywhere the conditional UPDATE makes
+        sure each job is claimed once.'''
+
+        now = time.time()
+        rows = (Job.query
+                .filter(self._claimable(now))
+                .order_by(Job.id)
+                .limit(limit)
+                .with_for_update(skip_locked = True)
+                .all())
+
+        claimed = []
+        for row in rows:
+            job = QueuedJob(row.id, row.kind, json.loads(row.payload), row.attempts + 1)
+            taken = db.session.execute(
+                db.update(Job)
+                  .where(Job.id == row.id, self._claimable(now))
+                  .values(status = 'running', claimed_at = now, attempts = Job.attempts + 1)
+            ).rowcount
+            if taken:
+                claimed.append(job)
+
+        db.session.commit()
+        return claimed
+
+    def _finish(self, job, **values):
+        db.session.execute(db.update(Job).where(Job.id == job.id).values(**values))
+        db.session.commit()
+
+    def done(self, job):
+        self._finish(job, status = 'done')
+
+    def retry(self, job, error, delay):
+        self._finish(job, status = 'queued', run_after = time.time() + delay, last_error = error)
+
+    def fail(self, job, error):
+        self._finish(job, status = 'failed', last_error = error)
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+
+def make_job_queue(kind):
+    '''JOB_QUEUE=db (default) or memory.'''
+
+    return MemoryJobQueue() if kind == 'memory' else DBJobQueue()
+
+
+class Worker():
+    '''Runs queued jobs. `handlers` maps a job kind to (run, give_up),
+    both called with the job's payload as keyword arguments.'''
+
+    def __init__(self, queue, handlers, max_attempts = 5, backoff = 2.0):
+        self.queue = queue
+        self.handlers = handlers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    def run_once(self, limit = 10):
+        '''Run up to `limit` due jobs. Returns how many were claimed.'''
+
+        jobs = self.queue.claim(limit)
+
+        for job in jobs:
+            run, give_up = self.handlers.get(job.kind, (None, None))
+            try:
+                if run is None:
+                    raise LookupError(f"no handler for {job.kind} jobs")
+                run(**job.payload)
+                self.queue.done(job)
+            except Exception as e:
+                db.session.rollback()
+                error = f"{type(e).__name__}: {e}"
+
+                if run is not None and job.attempts < self.max_attempts:
+                    log.warning("%s job %s failed on attempt %d, retrying: %s",
+                                job.kind, job.id, job.attempts, error)
+                    self.queue.retry(job, error, self.backoff ** job.attempts)
+                    continue
+
+                log.error("%s job %s failed after %d attempts: %s", job.kind, job.id, job.attempts, error)
+                if give_up is not None:
+                    try:
+                        give_up(**job.payload)
+                    except Exception as e:              # still mark the job failed, or it is claimed forever
+                        db.session.rollback()
+                        log.exception("giving up %s job %s failed", job.kind, job.id)
+                        error = f"{error}; give up: {type(e).__name__}: {e}"
+                self.queue.fail(job, error)
+
+        return len(jobs)
+
+    def run(self, poll = 1.0, stop = None):
+        '''Drain the queue until `stop` (a threading.Event) is set.'''
+
+        while stop is None or not stop.is_set():
+            if not self.run_once():
+                self.queue.wait(poll)
+
+
+def start_worker_thread(app, worker, poll = 0.5):
+    '''Run `worker` on a daemon thread inside an app context of `app`
+    (JOB_QUEUE=memory, where no separate worker process can see the jobs).'''
+
+    def run():
+        with app.app_context():
+            worker.run(poll = poll)
+
+    thread = threading.Thread(target = run, name = 'job-worker', daemon = True)
+    thread.start()
+    return thread
@@ -0,0 +1,125 @@
+'''Tiny in-process metrics registry rendered in Prometheus text format.
+
+Each worker process keeps its own numbers; scrape every worker (or run one
+worker per metrics port) to get the full picture.'''
+
+import threading
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    pairs = ','.join(f'{k}="{escape(v)}"' for k, v in sorted(labels.items()))
+    return '{' + pairs + '}'
+
+
+class Metric():
+
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self._values = {}
+
+    def inc(self, amount = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def lines(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{label_text(dict(k))} {v}" for k, v in values.items()]
+
+
+class Gauge(Metric):
+    '''Value read from `fn()` at scrape time, fn returns {labels tuple: value} or a number.'''
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def lines(self):
+        value = self.fn()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [f"{self.name}{label_text(dict(k))} {v}" for k, v in value.items()]
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        self._series = {}                               # labels -> [bucket counts..., count, sum]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def lines(self):
+        with self._lock:
+            snapshot = {k: list(v) for k, v in self._series.items()}
+
+        out = []
+        for key, series in snapshot.items():
+            labels = dict(key)
+            for bound, count in zip(self.buckets, series):
+                out.append(f"{self.name}_bucket{label_text({**labels, 'le': bound})} {count}")
+            out.append(f"{self.name}_bucket{label_text({**labels, 'le': '+Inf'})} {series[-2]}")
+            out.append(f"{self.name}_count{label_text(labels)} {series[-2]}")
+            out.append(f"{self.name}_sum{label_text(labels)} {series[-1]}")
+        return out
+
+
+class Registry():
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def gauge(self, name, help, fn):
+        return self._register(Gauge(name, help, fn))
+
+    def histogram(self, name, help, buckets = DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def render(self):
+        out = []
+        for metric in self._metrics.values():
+            out += metric.header() + metric.lines()
+        return '\n'.join(out) + '\n'
+
+
+registry = Registry()
@@ -0,0 +1,185 @@
+'''Schema migrations.
+
+`flask db-upgrade` runs every migration that is not recorded in the
+schema_migrations table yet, each in its own transaction. Migrations are
+written to be safe on both a fresh database and one created by the old
+db.create_all() schema.'''
+
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from models import db
+import sales
+import search
+
+MIGRATIONS = []                                         # (version, description, fn(conn))
+
+LOCATION_CURRENCIES = {'USA': 'USD', 'Canada': 'CAD', 'Mexico': 'MXN'}   # what Convert.check used to hardcode
+
+schema_migrations = sa.Table(
+    'schema_migrations', sa.MetaData(),
+    sa.Column('version', sa.Text, primary_key = True),
+    sa.Column('description', sa.Text, nullable = False),
+    sa.Column('applied_at', sa.DateTime, nullable = False),
+)
+
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return register
+
+
+def columns(conn, table):
+    return {c['name'] for c in sa.inspect(conn).get_columns(table)}
+
+
+def create_index(conn, table, name):
+    '''Create the model-declared index `name` on `table` if it is missing.'''
+
+    index = next(i for i in db.metadata.tables[table].indexes if i.name == name)
+    index.create(conn, checkfirst = True)
+
+
+def backfill_order_currency(conn):
+    '''Old totals were stored in the buyer's local currency with no label.
+    Label them the way Convert.check priced them, from the buyer's location.
+    That is the location now, so a buyer who has moved since gets the new
+    currency on old orders; there is nothing older to go on.'''
+
+    users = sa.table('users', sa.column('id'), sa.column('location'))
+    orders = sa.table('orders', sa.column('user_id'), sa.column('currency'))
+
+    location = sa.select(users.c.location).where(users.c.id == orders.c.user_id).scalar_subquery()
+    currency = sa.case(*[(location == l, c) for l, c in LOCATION_CURRENCIES.items()], else_ = 'USD')
+    conn.execute(orders.update().values(currency = currency))
+
+
+@migration('0001', 'create missing tables')
+def create_tables(conn):
+    db.metadata.create_all(conn)
+
+
+@migration('0002', 'integer money, product versions and order currency on old tables')
+def money_columns(conn):
+    products = columns(conn, 'products')
+
+    if 'price_cents' not in products:
+        conn.execute(sa.text("ALTER TABLE products ADD COLUMN price_cents INTEGER"))
+        conn.execute(sa.text(
+            "UPDATE products SET price_cents = CAST(ROUND(CAST(price AS NUMERIC) * 100) AS INTEGER)"))
+    if 'price' in products:
+        conn.execute(sa.text("ALTER TABLE products DROP COLUMN price"))
+    if 'version' not in products:
+        conn.execute(sa.text("ALTER TABLE products ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+    orders = columns(conn, 'orders')
+
+    if 'total_cents' not in orders:
+        conn.execute(sa.text("ALTER TABLE orders ADD COLUMN total_cents INTEGER"))
+        conn.execute(sa.text(
+            "UPDATE orders SET total_cents = CAST(ROUND(CAST(total AS NUMERIC) * 100) AS INTEGER)"))
+    if 'total' in orders:
+        conn.execute(sa.text("ALTER TABLE orders DROP COLUMN total"))
+    if 'currency' not in orders:
+        conn.execute(sa.text("ALTER TABLE orders ADD COLUMN currency TEXT NOT NULL DEFAULT 'USD'"))
+        backfill_order_currency(conn)
+    if 'rate_id' not in orders:
+        conn.execute(sa.text("ALTER TABLE orders ADD COLUMN rate_id INTEGER REFERENCES currency_rates (id)"))
+
+
+@migration('0003', 'indexes for category pages, order history and order lines')
+def hot_path_indexes(conn):
+    create_index(conn, 'products', 'ix_products_category_name_id')
+    create_index(conn, 'orders', 'ix_orders_user_id_timestamp_id')
+    create_index(conn, 'orders_products', 'ix_orders_products_order_id')
+    create_index(conn, 'orders_products', 'ix_orders_products_product_id')
+
+
+@migration('0004', 'full-text search index on products')
+def product_search(conn):
+    search.backend(conn.dialect.name).install(conn)
+
+
+@migration('0005', 'order status and the jobs table for async checkout')
+def async_checkout(conn):
+    if 'status' not in columns(conn, 'orders'):
+        conn.execute(sa.text("ALTER TABLE orders ADD COLUMN status TEXT NOT NULL DEFAULT 'placed'"))
+    db.metadata.tables['jobs'].create(conn, checkfirst = True)
+
+
+@migration('0006', 'order line prices and sales rollup tables')
+def sales_rollups(conn):
+    if 'price_cents' not in columns(conn, 'orders_products'):
+        conn.execute(sa.text("ALTER TABLE orders_products ADD COLUMN price_cents INTEGER"))
+    db.metadata.tables['sales_product_day'].create(conn, checkfirst = True)
+    db.metadata.tables['sales_category_day'].create(conn, checkfirst = True)
+
+
+@migration('0007', 'currencies for the shipped locations')
+def location_currencies(conn):
+    '''Prices used to be converted by a hardcoded location check; the
+    location_currencies table replaced it but started out empty, so every
+    upgraded shop showed USD to everyone. Rows an admin already added win.'''
+
+    table = db.metadata.tables['location_currencies']
+    present = {l for (l,) in conn.execute(sa.select(table.c.location))}
+    missing = [{'location': l, 'currency': c} for l, c in LOCATION_CURRENCIES.items() if l not in present]
+    if missing:
+        conn.execute(table.insert(), missing)
+
+
+@migration('0008', 'order line categories, order lines that outlive their products')
+def order_line_categories(conn):
+    if 'category' not in columns(conn, 'orders_products'):
+        conn.execute(sa.text("ALTER TABLE orders_products ADD COLUMN category TEXT"))
+    conn.execute(sa.text('''
+        UPDATE orders_products SET category =
+            (SELECT category FROM products WHERE products.id = orders_products.product_id)
+        WHERE category IS NULL'''))
+    conn.execute(sa.text('''
+        UPDATE orders_products SET price_cents =
+            (SELECT price_cents FROM products WHERE products.id = orders_products.product_id)
+        WHERE price_cents IS NULL'''))                  # lines from before 0006 freeze today's price
+
+    if conn.dialect.name != 'sqlite':                   # SQLite can't drop a constraint, nor enforces this one
+        for fk in sa.inspect(conn).get_foreign_keys('orders_products'):
+            if fk['constrained_columns'] == ['product_id'] and fk['name']:
+                conn.execute(sa.text(f'ALTER TABLE orders_products DROP CONSTRAINT "{fk["name"]}"'))
+
+    sales.rebuild(conn)
+
+
+def applied(conn):
+    schema_migrations.create(conn, checkfirst = True)
+    return {r.version for r in conn.execute(sa.select(schema_migrations.c.version))}
+
+
+def upgrade(engine, log = print):
+    '''Apply pending migrations in order. Returns the versions applied.'''
+
+    with engine.begin() as conn:
+        done = applied(conn)
+
+    ran = []
+    for version, description, fn in MIGRATIONS:
+        if version in done:
+            continue
+        with engine.begin() as conn:
+            fn(conn)
+            conn.execute(schema_migrations.insert().values(
+                version = version, description = description, applied_at = datetime.utcnow()))
+        log(f"{version} {description}")
+        ran.append(version)
+
+    return ran
+
+
+def status(engine):
+    '''[(version, description, applied?)] for every known migration.'''
+
+    with engine.begin() as conn:
+        done = applied(conn)
+    return [(version, description, version in done) for version, description, _ in MIGRATIONS]
@@ -2,10 +2,18 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload
+
+from fragments import cards
+from identity import identities
+from pagination import keyset_page, finite_float
+from pricing import to_minor
+from passwords import passwords
+import search
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 def connect_db(app):
@@ -76,7 +84,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash(password)
 
         user = User(
             username=username,
@@ -103,24 +111,28 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            if passwords.needs_rehash(user.password):     # move old hashes to the current cost
+                user.password = passwords.hash(password)
+                db.session.commit()
+            return user
 
         return False
+
+    def check_password(self, password):
+        return passwords.verify(self.password, password)
     
     @classmethod
-    def edit(cls, id, email, image_url, pw, location, address):
+    def edit(cls, user, email, image_url, pw, location, address):
+        '''Update an already loaded `user` if `pw` is their password.'''
 
-        user = cls.query.get_or_404(id)
-        
-        if cls.authenticate(user.username, pw):
+        if user.check_password(pw):
 
             user.email = email
             user.image_url = image_url
             user.location = location
             user.address = address
+            identities.invalidate(user.id)
 
             return user
         
@@ -132,6 +144,9 @@ class Product(db.Model):
     """An individual product."""
 
     __tablename__ = 'products'
+    __table_args__ = (
+        db.Index('ix_products_category_name_id', 'category', 'name', 'id'),     # categories_filter pages
+    )
 
     id = db.Column(
         db.Integer,
@@ -160,8 +175,8 @@ class Product(db.Model):
         nullable = False
     )
 
-    price = db.Column(
-        db.Float,
+    price_cents = db.Column(
+        db.Integer,                                     # USD cents, never a float
         nullable = False
     )
 
@@ -174,10 +189,29 @@ class Product(db.Model):
         nullable = True,
     )
 
-    in_order = db.relationship('Order', secondary = 'orders_products', backref = 'products')
+    version = db.Column(
+        db.Integer,
+        nullable = False,
+        default = 1                                     # bumped on every edit, part of cache keys
+    )
+
+    in_order = db.relationship('Order', secondary = 'orders_products',
+                               primaryjoin = 'Product.id == foreign(OrderProduct.product_id)',
+                               secondaryjoin = 'Order.id == foreign(OrderProduct.order_id)',
+                               viewonly = True)         # deleting a product keeps its order lines
 
     def __repr__(self):
         return f"<Product #{self.id}: {self.name}, {self.category}, {self.description}, {self.price}, {self.quantity}>"
+
+    @property
+    def price(self):
+        '''Price in USD, for forms. Stored as integer cents.'''
+
+        return self.price_cents / 100 if self.price_cents is not None else None
+
+    @price.setter
+    def price(self, value):
+        self.price_cents = to_minor(value)
     
 
     @classmethod
@@ -193,7 +227,9 @@ class Product(db.Model):
                           )
         
         db.session.add(product)
+        CatalogVersion.bump()
         db.session.commit()
+        cards.drop_product(product.id)
         return product
     
     @classmethod
@@ -203,19 +239,153 @@ class Product(db.Model):
 
         if product:
             product.name = name
-            product.category = category,
-            product.weight = weight,
-            product.description = description,
-            product.price = price,
-            product.quantity = quantity,
+            product.category = category
+            product.weight = weight
+            product.description = description
+            product.price = price
+            product.quantity = quantity
             product.image_url = image_url
+            product.version = (product.version or 1) + 1
+            CatalogVersion.bump()
+            cards.drop_product(product.id)
 
             return product
         
         else: return False
 
-    def displayed_price(self, rate):
-        return self.price * rate
+    _categories = {'version': None, 'rows': []}
+
+    @classmethod
+    def categories(cls):
+        '''[(category, product count)] sorted by category.
+
+        Computed with one GROUP BY and cached until the catalog version moves,
+        so a cache hit costs a single primary key lookup.'''
+
+        version = CatalogVersion.current()
+
+        if cls._categories['version'] != version:
+            rows = (db.session
+                    .query(cls.category, func.count(cls.id))
+                    .group_by(cls.category)
+                    .order_by(cls.category)
+                    .all())
+            cls._categories = {'version': version, 'rows': [tuple(r) for r in rows]}
+
+        return cls._categories['rows']
+
+    @classmethod
+    def page(cls, per_page, after = None, before = None, category = None):
+        '''One page of the catalog ordered by (name, id), optionally in one category.'''
+
+        query = cls.query
+        if category is not None:
+            query = query.filter(cls.category == category)
+
+        return keyset_page(query, [cls.name, cls.id], lambda p: [p.name, p.id],
+                           per_page, after = after, before = before, load = [str, int])
+
+    @classmethod
+    def search(cls, terms, per_page, after = None, before = None):
+        '''One page of products matching `terms`, best match first.
+
+        Ranked and keyset paginated on (rank, id), so each page is one
+        index lookup for the matches plus a top-N sort, never an OFFSET.'''
+
+        backend = search.backend(db.engine.dialect.name)
+        query, rank = backend.match(db.session.query(cls), cls.id, terms)
+        query = query.add_columns(rank.label('rank'))
+
+        page = keyset_page(query, [rank, cls.id], lambda row: [row.rank, row[0].id],
+                           per_page, after = after, before = before, desc = True,
+                           load = [finite_float, int])
+        page.items = [row[0] for row in page.items]
+        return page
+
+    @classmethod
+    def resolve_cart(cls, cart):
+        '''Load every product in `cart` (a Cart) with a single IN query
+        and reconcile quantities against stock.
+
+        Sold out and deleted products are dropped, quantities above stock
+        are lowered to what is available.'''
+
+        ids = list(cart)
+        found = {p.id: p for p in cls.query.filter(cls.id.in_(ids))} if ids else {}
+
+        resolved = ResolvedCart()
+
+        for product_id, quantity in cart.items():
+            product = found.get(product_id)
+
+            if product is None:
+                continue
+            if product.quantity == 0:
+                resolved.sold_out.append(product)
+                continue
+            if product.quantity < quantity:
+                resolved.reduced.append(product)
+                quantity = product.quantity
+
+            resolved.lines.append([product, quantity])
+
+        return resolved
+
+    @classmethod
+    def price_vector(cls):
+        '''(ids, USD cents) of the whole catalog in one two-column query.'''
+
+        rows = db.session.query(cls.id, cls.price_cents).order_by(cls.id).all()
+        return [r[0] for r in rows], [r[1] for r in rows]
+
+
+class ResolvedCart():
+    '''Result of Product.resolve_cart: [product, quantity] lines in cart order
+    and the products that were dropped or reduced.'''
+
+    def __init__(self):
+        self.lines = []
+        self.sold_out = []
+        self.reduced = []
+
+
+
+class CatalogVersion(db.Model):
+    '''Single row counter bumped in the same transaction as every catalog change.
+
+    In-process caches remember the version they were built at, so an edit
+    made through one worker invalidates the caches of all of them.'''
+
+    __tablename__ = 'catalog_version'
+
+    id = db.Column(
+        db.Integer,
+        primary_key = True
+    )
+
+    version = db.Column(
+        db.Integer,
+        nullable = False,
+        default = 0
+    )
+
+    @classmethod
+    def current(cls):
+        '''Current catalog version (0 before the first change).'''
+
+        row = db.session.get(cls, 1)                    # identity map keeps this to one query per request
+        return row.version if row else 0
+
+    @classmethod
+    def bump(cls):
+        '''Move the version forward. Caller commits.'''
+
+        updated = db.session.execute(
+            db.update(cls).where(cls.id == 1).values(version = cls.version + 1)
+        ).rowcount
+
+        if not updated:
+            db.session.add(cls(id = 1, version = 1))
 
 
 #     #################### ORDERS MODEL ####################
@@ -223,6 +393,9 @@ class Product(db.Model):
 class Order(db.Model):
     
     __tablename__ = 'orders' 
+    __table_args__ = (
+        db.Index('ix_orders_user_id_timestamp_id', 'user_id', 'timestamp', 'id'),   # order history pages
+    )
 
     id = db.Column(
         db.Integer,
@@ -239,41 +412,222 @@ class Order(db.Model):
     timestamp = db.Column(        
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow()
+        default=datetime.utcnow
     )
 
-    total = db.Column(
-        db.Float,
+    total_cents = db.Column(
+        db.Integer,                                     # minor units of `currency`
         nullable = False
     )
 
+    currency = db.Column(
+        db.Text,
+        nullable = False,
+        default = 'USD'
+    )
+
+    rate_id = db.Column(
+        db.Integer,
+        db.ForeignKey('currency_rates.id'),
+        nullable = True                                 # NULL when paid in base currency
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable = False,
+        default = 'placed'                              # CHECKOUT_MODE=async: pending -> placed | failed
+    )
+
+    lines = db.relationship('OrderProduct', cascade = 'all, delete-orphan')
+
+    products = db.relationship('Product', secondary = 'orders_products',
+                               primaryjoin = 'Order.id == foreign(OrderProduct.order_id)',
+                               secondaryjoin = 'Product.id == foreign(OrderProduct.product_id)',
+                               viewonly = True)         # products still in the catalog
+
+    @property
+    def total(self):
+        return self.total_cents / 100
+
+    @classmethod
+    def add(cls, user_id, total, products, currency):
+        '''Place an order for `products` ([product, quantity] pairs) with
+        `total` in minor units of `currency`.
+
+        Stock is taken with one conditional UPDATE per product
+        (`quantity >= wanted`), in product id order so concurrent checkouts
+        can't deadlock. If any product runs short the whole order is rolled
+        back and OutOfStock names it. Order lines go in as one bulk insert.'''
+
+        order = cls._start(user_id, total, products, currency, 'placed')
+        lines = cls._lines(products)
+        cls._add_lines(order.id, lines)
+        cls._record_sales(order.timestamp, lines)
+
+        db.session.commit()
+        return order
+
+    @classmethod
+    def reserve(cls, user_id, total, products, currency, queue):
+        '''CHECKOUT_MODE=async: take the stock and record a pending order,
+        leaving the order lines to a worker (the 'checkout' job, see
+        jobs.py and finalize()).
+
+        Stock is taken exactly as in add(), so pending orders can't
+        oversell. A transactional queue (the DB one) gets the job in the
+        same commit, so there is never an order without its job or the
+        other way round.'''
+
+        order = cls._start(user_id, total, products, currency, 'pending')
+        job = {'order_id': order.id, 'lines': cls._lines(products)}
+
+        if queue.transactional:
+            queue.enqueue('checkout', job)
+        db.session.commit()
+        if not queue.transactional:
+            queue.enqueue('checkout', job)
+        return order
+
+    @classmethod
+    def finalize(cls, order_id, lines):
+        '''Worker side of reserve(): write the order lines and mark the
+        order placed. Running it twice for one order is harmless.'''
+
+        placed = db.session.execute(
+            db.update(cls)
+              .where(cls.id == order_id, cls.status == 'pending')
+              .values(status = 'placed')
+        ).rowcount
+
+        if placed:
+            ids = [line[0] for line in lines]
+            current = {p.id: p for p in (db.session
+                                         .query(Product.id, Product.category, Product.price_cents)
+                                         .filter(Product.id.in_(ids)))}
+            # jobs queued before order lines carried a price or category fall back to the current ones
+            fallback = lambda p: [current[p].price_cents, current[p].category] if p in current else [0, '']
+            lines = [[p, q, *known, *fallback(p)[len(known):]] for p, q, *known in lines]
+
+            cls._add_lines(order_id, lines)
+            cls._record_sales(db.session.query(cls.timestamp).filter(cls.id == order_id).scalar(), lines)
+        db.session.commit()
+
+    @classmethod
+    def cancel(cls, order_id, lines):
+        '''Give up on a pending order: put its stock back and mark it failed.'''
+
+        failed = db.session.execute(
+            db.update(cls)
+              .where(cls.id == order_id, cls.status == 'pending')
+              .values(status = 'failed')
+        ).rowcount
+
+        if failed:
+            for product_id, quantity, *_ in sorted(lines):
+                db.session.execute(
+                    db.update(Product)
+                      .where(Product.id == product_id)
+                      .values(quantity = Product.quantity + quantity)
+                )
+        db.session.commit()
+
     @classmethod
-    def add(cls, user_id, total, products):
+    def _start(cls, user_id, total, products, currency, status):
+        '''Insert the order row and take its stock, in the caller's transaction.'''
+
         order = Order(
             user_id = user_id,
-            total = total
+            total_cents = total,
+            currency = currency.get('label'),
+            rate_id = currency.get('rate_id'),
+            status = status
         )
 
         db.session.add(order)
         db.session.flush()
 
-        for p in products:
-            order_product = OrderProduct(
-                order_id = order.id,
-                product_id = p[0].id,
-                quantity = p[1]
-                )
-            
-            db.session.add(order_product)
-            p[0].quantity = p[0].quantity - p[1]
-            
-        db.session.commit()
+        for product, quantity in sorted(products, key = lambda p: p[0].id):
+            taken = db.session.execute(
+                db.update(Product)
+                  .where(Product.id == product.id, Product.quantity >= quantity)
+                  .values(quantity = Product.quantity - quantity)
+            ).rowcount
+
+            if not taken:
+                db.session.rollback()
+                raise OutOfStock(product, quantity)
+
+        return order
+
+    @staticmethod
+    def _lines(products):
+        '''[product id, quantity, unit price in USD cents, category] per line.'''
+
+        return [[p.id, q, p.price_cents, p.category] for p, q in products]
+
+    @classmethod
+    def _add_lines(cls, order_id, lines):
+        db.session.execute(
+            db.insert(OrderProduct),
+            [{'order_id': order_id, 'product_id': p, 'quantity': q, 'price_cents': price, 'category': category}
+             for p, q, price, category in lines]
+        )
+
+    @staticmethod
+    def _record_sales(timestamp, lines):
+        '''Add a placed order's lines (see _lines) to the sales rollups, in
+        the order's transaction.'''
+
+        day = timestamp.date()
+        products, categories = {}, {}
+
+        for product_id, quantity, price, category in lines:
+            for totals, key in ((products, product_id), (categories, category)):
+                units, revenue = totals.get(key, (0, 0))
+                totals[key] = (units + quantity, revenue + quantity * price)
+
+        ProductSales.add(day, products)
+        CategorySales.add(day, categories)
+
+
+    @classmethod
+    def history(cls, user_id, per_page, after = None, before = None):
+        '''One page of a user's orders, newest first, keyset paginated on
+        (timestamp, id). Products are loaded for the whole page with one
+        extra IN query, so a page is always two queries.'''
+
+        query = (cls
+                 .query
+                 .filter(cls.user_id == user_id)
+                 .options(selectinload(cls.products)))
+
+        return keyset_page(query, [cls.timestamp, cls.id],
+                           lambda o: [o.timestamp.isoformat(), o.id],
+                           per_page, after = after, before = before, desc = True,
+                           load = [datetime.fromisoformat, int])
+
+    @classmethod
+    def count_for(cls, user_id):
+        return db.session.query(func.count(cls.id)).filter(cls.user_id == user_id).scalar()
+
+
+class OutOfStock(Exception):
+    '''Raised by Order.add when a product can't cover the ordered quantity.'''
+
+    def __init__(self, product, quantity):
+        self.product = product
+        self.quantity = quantity
+        super().__init__(f"Sorry, there is not enough {product.name} left for your order. Please check your cart.")
 
 
 class OrderProduct(db.Model):
     '''Mapping Order to Product'''
     
     __tablename__ = 'orders_products'
+    __table_args__ = (
+        db.Index('ix_orders_products_order_id', 'order_id'),
+        db.Index('ix_orders_products_product_id', 'product_id'),
+    )
 
     id = db.Column(
         db.Integer, 
@@ -284,12 +638,142 @@ class OrderProduct(db.Model):
     order_id = db.Column(
         db.Integer, 
         db.ForeignKey('orders.id'),
+        nullable = False
+    )
+
+    product_id = db.Column(
+        db.Integer,                                     # no FK: order lines outlive deleted products
+        nullable = False
+    )
+
+    quantity = db.Column(
+        db.Integer,
+        nullable = False
+    )
+
+    price_cents = db.Column(
+        db.Integer,                                     # USD unit price when ordered, NULL on old orders
+        nullable = True
+    )
+
+    category = db.Column(
+        db.Text,                                        # product category when ordered, NULL on old orders
+        nullable = True
+    )
+
+
+#     #################### CURRENCY MODELS ####################
+
+class CurrencyRate(db.Model):
+    '''Snapshot of a USD -> `label` rate, written by the refresher job.'''
+
+    __tablename__ = 'currency_rates'
+    __table_args__ = (
+        db.Index('ix_currency_rates_label_fetched_at', 'label', 'fetched_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key = True,
+        autoincrement = True
+    )
+
+    label = db.Column(
+        db.Text,
+        nullable = False
+    )
+
+    rate = db.Column(
+        db.Float,
+        nullable = False
+    )
+
+    fetched_at = db.Column(
+        db.DateTime,
+        nullable = False,
+        default = datetime.utcnow
+    )
+
+    def __repr__(self):
+        return f"<CurrencyRate #{self.id}: {self.label}, {self.rate}, {self.fetched_at}>"
+
+    @classmethod
+    def latest(cls, label):
+        '''Newest snapshot for `label` or None. Served by the (label, fetched_at) index.'''
+
+        return (cls
+                .query
+                .filter(cls.label == label)
+                .order_by(cls.fetched_at.desc())
+                .first())
+
+    @classmethod
+    def add(cls, label, rate):
+        snapshot = CurrencyRate(label = label, rate = rate)
+        db.session.add(snapshot)
+        db.session.commit()
+        return snapshot
+
+
+class LocationCurrency(db.Model):
+    '''Which currency prices are shown in for a user's location.'''
+
+    __tablename__ = 'location_currencies'
+
+    location = db.Column(
+        db.Text,
+        primary_key = True
+    )
+
+    currency = db.Column(
+        db.Text,
+        nullable = False
+    )
+
+    def __repr__(self):
+        return f"<LocationCurrency {self.location}: {self.currency}>"
+
+
+#     #################### CART MODELS ####################
+
+class StoredCart(db.Model):
+    '''Server-side cart. The session cookie only carries its id.'''
+
+    __tablename__ = 'carts'
+
+    id = db.Column(
+        db.Text,
+        primary_key = True
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete = 'CASCADE'),
+        nullable = True,
+        unique = True
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable = False,
+        default = datetime.utcnow
+    )
+
+
+class CartLine(db.Model):
+    '''One product line of a StoredCart.'''
+
+    __tablename__ = 'cart_lines'
+
+    cart_id = db.Column(
+        db.Text,
+        db.ForeignKey('carts.id', ondelete = 'CASCADE'),
         primary_key = True
     )
 
     product_id = db.Column(
-        db.Integer, 
-        db.ForeignKey('products.id'),
+        db.Integer,
+        db.ForeignKey('products.id', ondelete = 'CASCADE'),
         primary_key = True
     )
 
@@ -297,3 +781,180 @@ class OrderProduct(db.Model):
         db.Integer,
         nullable = False
     )
+
+    added_at = db.Column(
+        db.DateTime,
+        nullable = False,
+        default = datetime.utcnow
+    )
+
+
+#     #################### THROTTLE MODEL ####################
+
+class ThrottleBucket(db.Model):
+    '''Token bucket state shared by all workers (THROTTLE_STORE=db).'''
+
+    __tablename__ = 'throttle_buckets'
+
+    key = db.Column(
+        db.Text,
+        primary_key = True
+    )
+
+    tokens = db.Column(
+        db.Float,
+        nullable = False
+    )
+
+    updated_at = db.Column(
+        db.Float,                                       # unix time, keeps the refill math simple
+        nullable = False
+    )
+
+
+
+#     #################### SALES ROLLUP MODELS ####################
+
+def add_to_rollup(model, keys, day, totals):
+    '''Upsert `totals` ({key: (units, revenue_cents)}) into the rollup table
+    of `model` for `day`, adding onto rows that already exist. Keys go in
+    sorted order so concurrent checkouts lock rows in the same order.'''
+
+    if not totals:
+        return
+
+    table = model.__table__
+    insert = postgresql.insert if db.session.get_bind().dialect.name == 'postgresql' else sqlite.insert
+    stmt = insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements = ['day', keys],
+        set_ = {'units': table.c.units + stmt.excluded.units,
+                'revenue_cents': table.c.revenue_cents + stmt.excluded.revenue_cents})
+
+    db.session.execute(stmt, [{'day': day, keys: key, 'units': units, 'revenue_cents': revenue}
+                              for key, (units, revenue) in sorted(totals.items())])
+
+
+class ProductSales(db.Model):
+    '''Units sold and revenue (USD cents) per product and day, kept current
+    by every placed order. See sales.py for reports and rebuilding.'''
+
+    __tablename__ = 'sales_product_day'
+
+    day = db.Column(
+        db.Date,
+        primary_key = True
+    )
+
+    product_id = db.Column(
+        db.Integer,                                     # no FK: sales outlive deleted products
+        primary_key = True
+    )
+
+    units = db.Column(
+        db.Integer,
+        nullable = False,
+        default = 0
+    )
+
+    revenue_cents = db.Column(
+        db.BigInteger,
+        nullable = False,
+        default = 0
+    )
+
+    @classmethod
+    def add(cls, day, totals):
+        add_to_rollup(cls, 'product_id', day, totals)
+
+
+class CategorySales(db.Model):
+    '''Units sold and revenue (USD cents) per category and day.'''
+
+    __tablename__ = 'sales_category_day'
+
+    day = db.Column(
+        db.Date,
+        primary_key = True
+    )
+
+    category = db.Column(
+        db.Text,                                        # as it was when the order was placed
+        primary_key = True
+    )
+
+    units = db.Column(
+        db.Integer,
+        nullable = False,
+        default = 0
+    )
+
+    revenue_cents = db.Column(
+        db.BigInteger,
+        nullable = False,
+        default = 0
+    )
+
+    @classmethod
+    def add(cls, day, totals):
+        add_to_rollup(cls, 'category', day, totals)
+
+
+#     #################### JOBS MODEL ####################
+
+class Job(db.Model):
+    '''Background job in the DB queue (JOB_QUEUE=db), see jobs.py.'''
+
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_after', 'status', 'run_after'),          # what the worker claims next
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key = True,
+        autoincrement = True
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable = False
+    )
+
+    payload = db.Column(
+        db.Text,                                        # JSON
+        nullable = False
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable = False,
+        default = 'queued'                              # queued -> running -> done | failed
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable = False,
+        default = 0
+    )
+
+    run_after = db.Column(
+        db.Float,                                       # unix time, retries are pushed back
+        nullable = False
+    )
+
+    claimed_at = db.Column(
+        db.Float,
+        nullable = True
+    )
+
+    last_error = db.Column(
+        db.Text,
+        nullable = True
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable = False,
+        default = datetime.utcnow
+    )
@@ -0,0 +1,105 @@
+import base64
+import json
+import math
+
+from sqlalchemy import tuple_
+
+
+def encode_cursor(values):
+    '''Opaque, URL safe cursor from the sort key of a row.'''
+
+    raw = json.dumps(values, default = str, separators = (',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''Inverse of encode_cursor. Returns None for a missing or mangled cursor.'''
+
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        return json.loads(raw)
+    except ValueError:
+        return None
+
+
+class Page():
+    '''One page of a keyset paginated query.'''
+
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def finite_float(value):
+    '''float() that refuses NaN and infinities, for cursor values.'''
+
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"{value} is not a finite number")
+    return value
+
+
+def load_cursor(cursor, load):
+    '''Decoded cursor values converted with `load` (one callable per
+    column), or None unless the cursor is a list of exactly that many
+    convertible values. Anything else from the query string is treated
+    as no cursor at all.'''
+
+    values = decode_cursor(cursor)
+
+    if not isinstance(values, list) or len(values) != len(load):
+        return None
+    try:
+        return [convert(value) for convert, value in zip(load, values)]
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def keyset_page(query, columns, key, per_page, after = None, before = None, desc = False,
+                load = None):
+    '''Page through `query` ordered by `columns` without OFFSET.
+
+        `key(row)` returns the row's values for `columns`, `after`/`before` are
+        cursors from a previous page and `load` has one callable per column
+        that turns a decoded cursor value back into a column value (e.g. ISO
+        strings into datetimes). Every page is one indexed range scan of
+        per_page + 1 rows, however deep into the listing it is.'''
+
+    load = load or [lambda v: v] * len(columns)
+
+    after = load_cursor(after, load)
+    before = load_cursor(before, load) if after is None else None
+
+    going_back = before is not None
+
+    keys = tuple_(*columns)
+    forward = [c.desc() for c in columns] if desc else [c.asc() for c in columns]
+    backward = [c.asc() for c in columns] if desc else [c.desc() for c in columns]
+
+    if after is not None:
+        query = query.filter(keys < tuple_(*after) if desc else keys > tuple_(*after))
+    elif going_back:
+        query = query.filter(keys > tuple_(*before) if desc else keys < tuple_(*before))
+
+    rows = query.order_by(*(backward if going_back else forward)).limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if going_back:
+        rows.reverse()
+
+    has_next = going_back or more
+    has_prev = (after is not None) or (going_back and more)
+
+    return Page(rows,
+                encode_cursor(key(rows[-1])) if rows and has_next else None,
+                encode_cursor(key(rows[0])) if rows and has_prev else None)
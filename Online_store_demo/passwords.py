@@ -0,0 +1,49 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+import instrumentation
+
+
+class PasswordHasher():
+    '''Runs bcrypt on a small, fixed pool of threads.
+
+    bcrypt releases the GIL, so the pool gives real parallelism, and a
+    burst of logins queues for a free worker instead of every request
+    thread burning CPU at once. `rounds` is the cost new hashes get;
+    hashes with any other cost are reported by needs_rehash().'''
+
+    def __init__(self, rounds = 12, workers = 2, timeout = 30):
+        self.bcrypt = Bcrypt()
+        self.rounds = rounds
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'bcrypt')
+
+    def _run(self, op, fn, *args):
+        start = time.perf_counter()
+        try:
+            return self.pool.submit(fn, *args).result(self.timeout)
+        finally:
+            elapsed = time.perf_counter() - start       # includes the wait for a free worker
+            instrumentation.bcrypt_seconds.observe(elapsed, op = op)
+            instrumentation.record('bcrypt', elapsed)
+
+    def hash(self, password):
+        return self._run('hash', self.bcrypt.generate_password_hash, password, self.rounds).decode('UTF-8')
+
+    def verify(self, hashed, password):
+        return self._run('verify', self.bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        '''True if `hashed` (like $2b$12$...) was made with a different cost.'''
+
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+passwords = PasswordHasher(rounds = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12)),
+                           workers = int(os.environ.get('BCRYPT_WORKERS', os.cpu_count() or 2)))
@@ -0,0 +1,87 @@
+import threading
+from array import array
+from decimal import Decimal, ROUND_HALF_UP
+
+RATE_SCALE = 1_000_000                                  # rates are applied as integer parts per million
+
+
+def to_minor(amount):
+    '''Dollars (float, str or Decimal) -> integer cents, rounded half up.'''
+
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), rounding = ROUND_HALF_UP))
+
+
+def format_minor(minor):
+    '''Integer cents -> "12.34".'''
+
+    sign = '-' if minor < 0 else ''
+    return f"{sign}{abs(minor) // 100}.{abs(minor) % 100:02d}"
+
+
+def scaled_rate(rate):
+    return to_minor(Decimal(str(rate)) * RATE_SCALE / 100)
+
+
+def convert(minor, rate):
+    '''Cents in the base currency -> cents in the target currency, rounded half up.'''
+
+    return (minor * scaled_rate(rate) + RATE_SCALE // 2) // RATE_SCALE
+
+
+def convert_all(minors, rate):
+    '''convert() over a whole array of prices in one pass, integers only.'''
+
+    r = scaled_rate(rate)
+    half = RATE_SCALE // 2
+    return array('q', [(m * r + half) // RATE_SCALE for m in minors])
+
+
+class PriceBook():
+    '''Whole-catalog price vectors per currency.
+
+    `load()` returns (ids, base prices in cents) for every product, `version()`
+    the current catalog version. A vector is converted once per
+    (currency, rate snapshot, catalog version) and then shared by every list
+    page and cart total until one of them moves.'''
+
+    def __init__(self, load, version, keep = 8):
+        self.load = load
+        self.version = version
+        self.keep = keep
+        self._vectors = {}                              # key -> {product_id: minor units}
+        self._base = (None, None)                       # (catalog version, (ids, minors))
+        self._lock = threading.Lock()
+
+    def prices(self, currency):
+        '''{product_id: price in the currency's minor units}.'''
+
+        version = self.version()
+        key = (currency.get('label'), currency.get('rate_id'), currency.get('rate'), version)
+
+        vector = self._vectors.get(key)
+        if vector is not None:
+            return vector
+
+        with self._lock:
+            vector = self._vectors.get(key)
+            if vector is not None:
+                return vector
+
+            if self._base[0] != version:
+                ids, minors = self.load()
+                self._base = (version, (array('q', ids), array('q', minors)))
+            ids, minors = self._base[1]
+
+            vector = dict(zip(ids, convert_all(minors, currency.get('rate'))))
+
+            self._vectors = {k: v for k, v in self._vectors.items() if k[3] == version}
+            if len(self._vectors) >= self.keep:
+                self._vectors.clear()
+            self._vectors[key] = vector
+
+        return vector
+
+    def clear(self):
+        with self._lock:
+            self._vectors = {}
+            self._base = (None, None)
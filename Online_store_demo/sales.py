@@ -0,0 +1,111 @@
+'''Sales reports from the rollup tables (sales_product_day, sales_category_day).
+
+Every placed order adds its lines to the rollups in its own transaction
+(Order.add, or Order.finalize for async checkouts), so a report only reads
+days x categories and days x products rows. How many orders there are
+never matters. Revenue is in USD cents at the prices the orders were
+placed at.
+
+rebuild() recomputes the rollups from the order tables, e.g. after a
+restore or for orders placed before the rollups existed
+(`flask sales-rollup`). Order lines keep the price and category they were
+sold at and outlive deleted products, so a rebuild gives the same totals
+as the live rollups; only orders deleted along with their user drop out.
+Run it when no checkouts are happening, or give it a start day that no
+open checkout can fall on.'''
+
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+from models import db, Order, OrderProduct, Product, ProductSales, CategorySales
+
+
+def report(start, end, top = 20):
+    '''Totals for the days start..end (inclusive): per day, per category and the `top` products.'''
+
+    in_range = lambda model: model.day.between(start, end)
+
+    days = (db.session
+            .query(CategorySales.day,
+                   sa.func.sum(CategorySales.units),
+                   sa.func.sum(CategorySales.revenue_cents))
+            .filter(in_range(CategorySales))
+            .group_by(CategorySales.day)
+            .order_by(CategorySales.day)
+            .all())
+
+    categories = (db.session
+                  .query(CategorySales.category,
+                         sa.func.sum(CategorySales.units),
+                         sa.func.sum(CategorySales.revenue_cents).label('revenue'))
+                  .filter(in_range(CategorySales))
+                  .group_by(CategorySales.category)
+                  .order_by(sa.desc('revenue'), CategorySales.category)
+                  .all())
+
+    products = (db.session
+                .query(ProductSales.product_id,
+                       sa.func.sum(ProductSales.units),
+                       sa.func.sum(ProductSales.revenue_cents).label('revenue'))
+                .filter(in_range(ProductSales))
+                .group_by(ProductSales.product_id)
+                .order_by(sa.desc('revenue'), ProductSales.product_id)
+                .limit(top)
+                .all())
+
+    names = dict(db.session.query(Product.id, Product.name)
+                 .filter(Product.id.in_([p for p, _, _ in products]))) if products else {}
+
+    return {
+        'days': [(day, int(units), int(revenue)) for day, units, revenue in days],
+        'categories': [(category, int(units), int(revenue)) for category, units, revenue in categories],
+        'products': [(names.get(p, f"#{p} (deleted)"), int(units), int(revenue)) for p, units, revenue in products],
+        'units': sum(int(u) for _, u, _ in days),
+        'revenue': sum(int(r) for _, _, r in days),
+    }
+
+
+def last_days(n, today = None):
+    '''(start, end) of the `n` days up to and including today (UTC).'''
+
+    end = today or datetime.utcnow().date()
+    return end - timedelta(days = n - 1), end
+
+
+def rebuild(conn, since = None):
+    '''Recompute the rollups on `conn` from placed orders, for every day
+    from `since` (a date) on, or for all days. Returns rows written.
+
+    Migration 0008 gave order lines from before line prices were stored
+    their product's price at upgrade time; any it couldn't price (the
+    product was already gone) count as nothing.'''
+
+    orders, lines, products = Order.__table__, OrderProduct.__table__, Product.__table__
+    day = sa.func.date(orders.c.timestamp)
+    units = sa.func.sum(lines.c.quantity)
+    price = sa.func.coalesce(lines.c.price_cents, products.c.price_cents, 0)
+    revenue = sa.func.sum(lines.c.quantity * price)
+    category = sa.func.coalesce(lines.c.category, products.c.category, '')
+
+    source = (lines.join(orders, orders.c.id == lines.c.order_id)
+                   .outerjoin(products, products.c.id == lines.c.product_id))
+    placed = orders.c.status == 'placed'
+    if since is not None:
+        placed = sa.and_(placed, orders.c.timestamp >= since)
+
+    written = 0
+    for model, column, key in ((ProductSales, 'product_id', lines.c.product_id),
+                               (CategorySales, 'category', category)):
+        table = model.__table__
+        delete = table.delete()
+        if since is not None:
+            delete = delete.where(table.c.day >= since)
+        conn.execute(delete)
+
+        select = sa.select(day, key, units, revenue).select_from(source).where(placed).group_by(day, key)
+        written += conn.execute(
+            table.insert().from_select(['day', column, 'units', 'revenue_cents'], select)
+        ).rowcount
+
+    return written
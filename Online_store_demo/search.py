@@ -0,0 +1,111 @@
+'''Full-text product search over name, category and description.
+
+Postgres keeps a generated tsvector column (products.search_vector) with a
+GIN index; SQLite keeps an FTS5 table (products_fts) that triggers update
+on every insert, update and delete of a product. Either way the index is
+current as soon as Product.add / Product.edit (or a bulk import) commits,
+and a search only touches matching rows. Both are created by migration
+0004.
+
+Name matches weigh more than category matches, which weigh more than
+description matches.'''
+
+import re
+
+import sqlalchemy as sa
+from sqlalchemy import func, literal_column
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+class PostgresSearch():
+
+    vector = literal_column('products.search_vector')
+
+    def install(self, conn):
+        conn.execute(sa.text('''
+            ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(category, '')), 'B') ||
+                setweight(to_tsvector('english', coalesce(description, '')), 'C')
+            ) STORED'''))
+        conn.execute(sa.text(
+            "CREATE INDEX IF NOT EXISTS ix_products_search ON products USING GIN (search_vector)"))
+
+    def match(self, query, id_column, terms):
+        '''`query` narrowed to matching products, plus a rank expression (higher is better).'''
+
+        tsquery = func.websearch_to_tsquery('english', terms)
+        return (query.filter(self.vector.op('@@')(tsquery)),
+                func.ts_rank_cd(self.vector, tsquery))
+
+
+class SqliteSearch():
+
+    fts = sa.table('products_fts', sa.column('rowid'))
+
+    TRIGGERS = {
+        'products_fts_insert': '''
+            AFTER INSERT ON products BEGIN
+                INSERT INTO products_fts (rowid, name, category, description)
+                VALUES (new.id, new.name, new.category, new.description);
+            END''',
+        'products_fts_delete': '''
+            AFTER DELETE ON products BEGIN
+                INSERT INTO products_fts (products_fts, rowid, name, category, description)
+                VALUES ('delete', old.id, old.name, old.category, old.description);
+            END''',
+        'products_fts_update': '''
+            AFTER UPDATE OF name, category, description ON products BEGIN
+                INSERT INTO products_fts (products_fts, rowid, name, category, description)
+                VALUES ('delete', old.id, old.name, old.category, old.description);
+                INSERT INTO products_fts (rowid, name, category, description)
+                VALUES (new.id, new.name, new.category, new.description);
+            END''',
+    }
+
+    def install(self, conn):
+        conn.execute(sa.text("DROP TABLE IF EXISTS products_fts"))
+        conn.execute(sa.text('''
+            CREATE VIRTUAL TABLE products_fts USING fts5(
+                name, category, description,
+                content = 'products', content_rowid = 'id', tokenize = 'porter unicode61')'''))
+
+        for name, body in self.TRIGGERS.items():
+            conn.execute(sa.text(f"DROP TRIGGER IF EXISTS {name}"))
+            conn.execute(sa.text(f"CREATE TRIGGER {name} {body}"))
+
+        conn.execute(sa.text("INSERT INTO products_fts (products_fts) VALUES ('rebuild')"))
+
+    @staticmethod
+    def fts_query(terms):
+        '''User input as an FTS5 query: every word must match, the last one
+        as a prefix (so "choc" finds "chocolate"). Quoting every word keeps
+        FTS5 operators and stray quotes from being a syntax error.'''
+
+        words = TOKEN.findall(terms)
+        if not words:
+            return None
+        quoted = [f'"{w}"' for w in words]
+        quoted[-1] += '*'
+        return ' '.join(quoted)
+
+    def match(self, query, id_column, terms):
+        table = literal_column('products_fts')
+        query = (query.join(self.fts, self.fts.c.rowid == id_column)
+                      .filter(table.op('MATCH')(self.fts_query(terms) or '""')))
+        # bm25 is lower-is-better; column weights follow the table: name, category, description
+        return query, -func.bm25(table, 10.0, 4.0, 1.0)
+
+
+BACKENDS = {'postgresql': PostgresSearch(), 'sqlite': SqliteSearch()}
+
+
+def backend(dialect_name):
+    '''Search backend for a SQLAlchemy dialect name, e.g. engine.dialect.name.'''
+
+    try:
+        return BACKENDS[dialect_name]
+    except KeyError:
+        raise RuntimeError(f"Product search is not supported on {dialect_name}")
@@ -1,8 +1,13 @@
 from models import *
-from app import app
+from app import create_app
+import migrations
+
+app = create_app()
+app.app_context().push()
 
 db.drop_all()
-db.create_all()
+migrations.schema_migrations.drop(db.engine, checkfirst = True)
+migrations.upgrade(db.engine, log = lambda line: None)
 
 '''username, location, address, password , email, image_url'''
 
@@ -0,0 +1,74 @@
+'''Shared fixtures: an app on a throwaway SQLite file with the schema built
+by the migrations, fixture currency rates and cheap bcrypt.'''
+
+import pytest
+
+from app import create_app, price_book
+from convert import Convert, FixtureProvider
+from fragments import cards
+from identity import identities
+from models import db, User, Product
+from passwords import passwords
+import migrations
+
+RATES = {'MXN': 17.05, 'CAD': 1.35}
+PASSWORD = 'qwe123'
+
+passwords.rounds = 4
+
+
+def reset_caches():
+    '''In-process caches are keyed on ids and versions that restart with every test database.'''
+
+    Convert.set_provider(FixtureProvider(RATES))
+    Convert._locations_at = None
+    Product._categories = {'version': None, 'rows': []}
+    price_book.clear()
+    identities.clear()
+    cards.clear()
+
+
+@pytest.fixture
+def config():
+    '''Extra app settings; override this fixture in a test module to change them.'''
+
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, config):
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'shop.db'}",
+        'SQLALCHEMY_ENGINE_OPTIONS': {'connect_args': {'timeout': 30}},
+        'WTF_CSRF_ENABLED': False,
+        'CART_STORE': 'memory',
+        'THROTTLE_USER': '1000/1',
+        'THROTTLE_IP': '1000/1',
+        **config,
+    })
+    reset_caches()
+
+    with app.app_context():
+        migrations.upgrade(db.engine, log = lambda line: None)
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def make_user(username, location = 'USA'):
+    return User.signup(username, location, 'somewhere', PASSWORD, f"{username}@example.com")
+
+
+def make_product(name, quantity = 10, price = 2.5, category = 'Snacks'):
+    return Product.add(name, category, 100, f"{name} description", price, quantity, '')
+
+
+def login(client, username):
+    response = client.post('/login', data = {'username': username, 'password': PASSWORD})
+    assert response.status_code == 302
+    return client
@@ -0,0 +1,164 @@
+import csv
+import io
+import json
+
+import pytest
+
+import bulk
+from app import ADMIN_ID
+from conftest import make_user, make_product, login
+from models import db, Product, CatalogVersion
+
+CATALOG = [
+    {'name': 'Bread loaf', 'category': 'Bread', 'weight': '250', 'description': 'Bread is bread',
+     'price': '3.25', 'quantity': '5', 'image_url': ''},
+    {'name': 'Ogurchik', 'category': 'Katanki', 'weight': '600', 'description': 'Salty cucumbers',
+     'price': '5.89', 'quantity': '11', 'image_url': ''},
+]
+
+
+def as_file(fmt, rows):
+    if fmt == 'json':
+        return io.StringIO(json.dumps(rows))
+    if fmt == 'jsonl':
+        return io.StringIO(''.join(json.dumps(r) + '\n' for r in rows))
+    text = io.StringIO()
+    writer = csv.DictWriter(text, fieldnames = bulk.FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
+    text.seek(0)
+    return text
+
+
+@pytest.mark.parametrize('path, fmt', [
+    ('catalog.csv', 'csv'), ('catalog.jsonl', 'jsonl'), ('catalog.ndjson', 'jsonl'),
+    ('catalog.json', 'json'), ('<stdin>', 'csv'),
+])
+def test_guess_format(path, fmt):
+    assert bulk.guess_format(path) == fmt
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'jsonl', 'json'])
+def test_import_and_export_round_trip(app, fmt):
+    make_product('Bread loaf', quantity = 1, price = 1.0, category = 'Old')
+
+    count, _ = bulk.import_products(as_file(fmt, CATALOG), fmt)
+
+    assert count == 2
+    bread = Product.query.filter_by(name = 'Bread loaf').one()
+    assert (bread.category, bread.price_cents, bread.quantity, bread.version) == ('Bread', 325, 5, 2)
+
+    out = io.StringIO()
+    assert bulk.export_products(out, fmt)[0] == 2
+    out.seek(0)
+    assert [r['price'] for r in bulk.read_rows(out, fmt)] == ['3.25', '5.89']
+
+
+def test_empty_json_export_is_a_list(app):
+    out = io.StringIO()
+    bulk.export_products(out, 'json')
+    assert json.loads(out.getvalue()) == []
+
+
+def test_json_must_be_a_list(app):
+    with pytest.raises(ValueError, match = 'JSON list'):
+        bulk.import_products(io.StringIO(json.dumps(CATALOG[0])), 'json')
+
+
+def test_bad_row_imports_nothing(app):
+    rows = CATALOG + [dict(CATALOG[0], name = 'Broken', quantity = 'lots')]
+
+    with pytest.raises(ValueError, match = 'row 3'):
+        bulk.import_products(as_file('jsonl', rows), 'jsonl')
+    assert Product.query.count() == 0
+
+
+def test_products_update_reads_a_json_list(app, tmp_path):
+    bread = make_product('Bread loaf', quantity = 5)
+    path = tmp_path / 'changes.json'
+    path.write_text(json.dumps([{'id': bread.id, 'quantity_delta': 24}]))
+
+    result = app.test_cli_runner().invoke(args = ['products-update', str(path)])
+
+    assert result.exit_code == 0, result.output
+    assert db.session.get(Product, bread.id).quantity == 29
+
+
+@pytest.mark.parametrize('item, error', [
+    ({'id': 1, 'price': 'abc'}, 'price must be a number'),
+    ({'id': 1, 'price': 'NaN'}, 'price must be a number'),
+    ({'id': 'x', 'quantity': 1}, 'id must be a whole number'),
+    ({'id': 1, 'quantity': '2.5'}, 'quantity must be a whole number'),
+    ({'id': 1, 'quantity_delta': [1]}, 'quantity_delta must be a whole number'),
+    ({'quantity': 1}, 'needs an id or a name'),
+    ({'id': 1}, 'nothing to change'),
+    ({'id': 1, 'quantity': 1, 'quantity_delta': 1}, 'not both'),
+    ({'id': 1, 'price': '-1'}, "can't be negative"),
+    ({'id': 10 ** 20, 'quantity': 1}, 'id is out of range'),
+    ({'id': 1, 'quantity': 10 ** 20}, 'quantity is out of range'),
+    ({'id': 1, 'quantity_delta': -2 ** 31}, 'quantity_delta is out of range'),
+    ({'id': 1, 'price_cents': 2 ** 31}, 'price_cents is out of range'),
+    ({'id': 1, 'price': '1e12'}, 'price is out of range'),
+    ('3', 'expected an object'),
+])
+def test_parse_update_explains_bad_items(item, error):
+    with pytest.raises(ValueError, match = error):
+        bulk.parse_update(item)
+
+
+def test_update_stock(app):
+    bread = make_product('Bread loaf', quantity = 5, price = 3.25)
+    pickles = make_product('Ogurchik', quantity = 2, price = 5.89)
+    version = CatalogVersion.current()
+
+    results = bulk.update_stock([
+        {'id': bread.id, 'quantity_delta': 24},
+        {'name': 'Ogurchik', 'quantity': 10, 'price': '6.10'},
+        {'id': bread.id, 'quantity_delta': -30},        # only 29 left after the first item
+        {'id': bread.id, 'quantity_delta': -4, 'price_cents': 349},
+        {'name': 'Missing', 'quantity': 1},
+        {'id': bread.id, 'price': 'abc'},
+    ])
+
+    assert [r['status'] for r in results] == ['updated', 'updated', 'rejected', 'updated', 'not_found', 'invalid']
+    assert results[2]['error'] == 'only 29 in stock'
+    assert results[3]['quantity'] == 25 and results[3]['price'] == '3.49'
+    assert results[5]['error'] == 'price must be a number'
+
+    db.session.expire_all()
+    assert (bread.quantity, bread.price_cents, bread.version) == (25, 349, 2)
+    assert (pickles.quantity, pickles.price_cents, pickles.version) == (10, 610, 2)
+    assert CatalogVersion.current() == version + 1
+
+
+def test_update_stock_with_nothing_valid_changes_nothing(app):
+    version = CatalogVersion.current()
+
+    assert [r['status'] for r in bulk.update_stock([{'name': 'Missing', 'quantity': 1}, {}])] == \
+        ['not_found', 'invalid']
+    assert CatalogVersion.current() == version
+
+
+def test_update_stock_rejects_stock_past_the_column_range(app):
+    bread = make_product('Bread loaf', quantity = 5)
+
+    results = bulk.update_stock([{'id': bread.id, 'quantity': bulk.INT_MAX},
+                                 {'id': bread.id, 'quantity_delta': 1}])
+
+    assert [r['status'] for r in results] == ['updated', 'rejected']
+    assert db.session.get(Product, bread.id).quantity == bulk.INT_MAX
+
+
+def test_batch_endpoint_reports_huge_numbers_and_keeps_the_valid_rows(app, client):
+    make_user(ADMIN_ID)
+    bread = make_product('Bread loaf', quantity = 5)
+    login(client, ADMIN_ID)
+
+    response = client.post('/products/batch', json = [{'id': bread.id, 'quantity': 10 ** 20},
+                                                      {'id': 10 ** 20, 'quantity': 1},
+                                                      {'id': bread.id, 'quantity_delta': 2}])
+
+    assert response.status_code == 200
+    assert [r['status'] for r in response.json['results']] == ['invalid', 'invalid', 'updated']
+    assert response.json['results'][0]['error'] == 'quantity is out of range'
+    assert db.session.get(Product, bread.id).quantity == 7
@@ -0,0 +1,94 @@
+import pytest
+
+from conftest import make_user, make_product, login, PASSWORD, RATES
+from convert import Convert, FixtureProvider
+from models import db, Order, Product
+
+
+@pytest.fixture
+def shopper(app, client):
+    make_user('ann', location = 'Mexico')
+    bread = make_product('Bread', quantity = 10, price = 3.25)
+    login(client, 'ann').get('/')                       # shows and drops the welcome flash
+    return bread
+
+
+def get(client, url, etag = None):
+    return client.get(url, headers = {'If-None-Match': etag} if etag else {})
+
+
+def assert_changed(client, url, etag):
+    response = get(client, url, etag)
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    return response
+
+
+@pytest.mark.parametrize('url', ['/', '/categories', '/categories/Snacks', '/products/{id}'])
+def test_unchanged_page_is_not_modified(client, shopper, url):
+    url = url.format(id = shopper.id)
+    first = get(client, url)
+    assert first.status_code == 200
+    assert first.headers['Cache-Control'] == 'private, no-cache'
+
+    again = get(client, url, first.headers['ETag'])
+    assert again.status_code == 304
+    assert again.headers['ETag'] == first.headers['ETag'] and again.data == b''
+
+
+def test_catalog_edit_changes_the_etag(client, shopper):
+    etag = get(client, '/').headers['ETag']
+
+    Product.edit(shopper.id, 'Rye bread', 'Snacks', 100, 'rye', 3.25, 10, '')
+    db.session.commit()
+
+    assert b'Rye bread' in assert_changed(client, '/', etag).data
+
+
+def test_stock_change_changes_the_product_etag(client, shopper):
+    url = f"/products/{shopper.id}"
+    etag = get(client, url).headers['ETag']
+
+    Order.add(1, 0, [[shopper, 3]], {'label': 'USD', 'rate_id': None})
+
+    assert_changed(client, url, etag)
+
+
+def test_profile_edit_changes_the_etag(client, shopper):
+    etag = get(client, '/').headers['ETag']
+
+    client.post('/users/update', data = {'location': 'Canada', 'password': PASSWORD})
+    get(client, '/')                                    # drains the "Profile updated." flash
+
+    assert b'CAD' in assert_changed(client, '/', etag).data
+
+
+def test_rate_change_changes_the_etag(client, shopper):
+    etag = get(client, '/').headers['ETag']
+
+    Convert.set_provider(FixtureProvider(dict(RATES, MXN = 18.2)))
+
+    assert_changed(client, '/', etag)
+
+
+def test_flash_pages_are_not_cached(client, shopper):
+    etag = get(client, '/').headers['ETag']
+    with client.session_transaction() as session:
+        session['_flashes'] = [('success', 'Hello again')]
+
+    response = get(client, '/', etag)
+
+    assert response.status_code == 200 and b'Hello again' in response.data
+    assert 'ETag' not in response.headers
+    assert response.headers['Cache-Control'] == 'no-cache, no-store, must-revalidate'
+
+
+def test_static_files_are_immutable_only_when_fingerprinted(client, shopper):
+    page = get(client, '/').data.decode()
+    assert '/static/stylesheets/style.css?v=' in page
+
+    fingerprinted = client.get('/static/stylesheets/style.css?v=abc')
+    plain = client.get('/static/stylesheets/style.css')
+
+    assert fingerprinted.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    assert plain.headers['Cache-Control'] == 'public, max-age=3600'
@@ -0,0 +1,65 @@
+import pytest
+
+from app import CART, cart_store
+from cart import Cart
+from cart_store import MemoryCartStore, DBCartStore
+from conftest import make_user, make_product, login
+
+
+def test_add_replaces_a_line_and_keeps_order():
+    cart = Cart()
+    assert not cart.add(1, 2)
+    assert not cart.add(2, 1)
+    assert cart.add(1, 5)
+
+    assert list(cart.items()) == [(2, 1), (1, 5)]
+
+
+def test_update_remove_and_merge():
+    cart = Cart([(1, 2), (2, 1)])
+    cart.update(1, 3)
+    cart.update(9, 3)                                   # not in the cart, ignored
+    cart.remove(2)
+    cart.remove(9)
+    cart.merge(Cart([(1, 1), (3, 4)]))
+
+    assert dict(cart.items()) == {1: 4, 3: 4}
+    assert 3 in cart and 2 not in cart and len(cart) == 2
+
+
+def test_from_session_reads_both_old_forms():
+    assert dict(Cart.from_session([[1, 2], [3, 4]]).items()) == {1: 2, 3: 4}
+    assert dict(Cart.from_session([{'product_id': 1, 'quantity': 2}]).items()) == {1: 2}
+    assert len(Cart.from_session(None)) == 0
+
+
+@pytest.mark.parametrize('store', [MemoryCartStore, DBCartStore])
+def test_store_lines(app, store):
+    user = make_user('shopper')
+    store = store()
+    cart_id = store.for_user(user.id)
+
+    assert store.for_user(user.id) == cart_id
+    assert not store.set_line(cart_id, 1, 2)
+    assert store.set_line(cart_id, 1, 3)
+    store.set_line(cart_id, 2, 1)
+    store.remove_line(cart_id, 2)
+    assert dict(store.load(cart_id).items()) == {1: 3}
+
+    store.clear(cart_id)
+    assert len(store.load(cart_id)) == 0
+
+
+def test_old_session_cart_moves_to_the_store(app, client):
+    user = make_user('shopper')
+    product = make_product('Bread')
+    login(client, 'shopper')
+    with client.session_transaction() as session:
+        session[CART] = [[product.id, 2]]
+
+    assert client.get('/cart').status_code == 200
+
+    with client.session_transaction() as session:
+        cart_id = session[CART]
+    assert cart_id == cart_store().for_user(user.id)
+    assert dict(cart_store().load(cart_id).items()) == {product.id: 2}
@@ -0,0 +1,71 @@
+import threading
+
+from sqlalchemy import func
+
+from models import db, Order, OrderProduct, OutOfStock, Product
+from conftest import make_user, make_product
+
+
+def test_order_add_takes_stock_and_writes_lines(app):
+    user = make_user('buyer')
+    product = make_product('Bread', quantity = 5)
+
+    order = Order.add(user.id, 500, [[product, 2]], {'label': 'USD', 'rate_id': None})
+
+    assert db.session.get(Product, product.id).quantity == 3
+    assert [(p.product_id, p.quantity) for p in OrderProduct.query.filter_by(order_id = order.id)] == [(product.id, 2)]
+
+
+def test_order_add_out_of_stock_rolls_back(app):
+    user = make_user('buyer')
+    plenty = make_product('Bread', quantity = 5)
+    scarce = make_product('Caviar', quantity = 1)
+
+    try:
+        Order.add(user.id, 100, [[plenty, 2], [scarce, 2]], {'label': 'USD', 'rate_id': None})
+        assert False, "expected OutOfStock"
+    except OutOfStock as e:
+        assert e.product.id == scarce.id
+
+    assert db.session.get(Product, plenty.id).quantity == 5
+    assert Order.query.count() == 0
+
+
+def test_concurrent_checkouts_never_oversell(app):
+    '''Many threads buy one scarce product at once: stock never goes below
+    zero and every unit is accounted for.'''
+
+    stock, threads, tries = 15, 8, 5
+    users = [make_user(f"buyer{n}").id for n in range(threads)]
+    product_id = make_product('Caviar', quantity = stock).id
+    barrier = threading.Barrier(threads)
+    errors = []
+
+    def buy(user_id):
+        with app.app_context():
+            barrier.wait()
+            for _ in range(tries):
+                product = db.session.get(Product, product_id)
+                try:
+                    Order.add(user_id, 100, [[product, 1]], {'label': 'USD', 'rate_id': None})
+                except OutOfStock:
+                    pass
+                except Exception as e:                  # anything else is a bug
+                    db.session.rollback()
+                    errors.append(e)
+            db.session.remove()
+
+    workers = [threading.Thread(target = buy, args = (u,)) for u in users]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    db.session.expire_all()
+    remaining = db.session.get(Product, product_id).quantity
+    sold = db.session.query(func.coalesce(func.sum(OrderProduct.quantity), 0)).filter_by(product_id = product_id).scalar()
+
+    assert errors == []
+    assert remaining >= 0
+    assert sold + remaining == stock
+    assert sold == stock                                # 40 attempts for 15 units: all of it sells
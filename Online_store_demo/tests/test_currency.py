@@ -0,0 +1,130 @@
+import logging
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as shop
+from convert import Convert, FixtureProvider, SnapshotProvider, refresh_rates
+from conftest import make_user, make_product, login, RATES
+from models import db, CurrencyRate, Order
+
+
+class FlakyProvider(FixtureProvider):
+    '''Fixture rates, except the currencies in `down` time out.'''
+
+    def __init__(self, rates, down = ()):
+        super().__init__(rates)
+        self.down = set(down)
+
+    def rate(self, base, conv_to):
+        if conv_to in self.down:
+            raise TimeoutError(f"{conv_to} timed out")
+        return super().rate(base, conv_to)
+
+
+@pytest.fixture
+def snapshots(app):
+    '''Convert reading rates from the currency_rates table, as in production.'''
+
+    Convert.set_provider(SnapshotProvider(upstream = FixtureProvider(RATES)))
+    return Convert.rates.provider
+
+
+def test_refresh_stores_the_currencies_that_worked(app):
+    snapshots, failed = refresh_rates(FlakyProvider(RATES, down = ['CAD']))
+
+    assert [(s.label, s.rate) for s in snapshots] == [('MXN', 17.05)]
+    assert failed == {'CAD': 'TimeoutError: CAD timed out'}
+    assert CurrencyRate.latest('MXN').rate == 17.05
+    assert CurrencyRate.latest('CAD') is None
+
+
+def test_snapshot_provider_serves_the_newest_snapshot(app, snapshots):
+    old = CurrencyRate.add('MXN', 16.0)
+    old.fetched_at = datetime.utcnow() - timedelta(minutes = 5)
+    new = CurrencyRate.add('MXN', 18.0)
+
+    assert snapshots.rate('USD', 'MXN') == {'rate': 18.0, 'rate_id': new.id}
+
+
+def test_snapshot_provider_fetches_upstream_only_without_a_snapshot(app, snapshots):
+    first = snapshots.rate('USD', 'CAD')
+    snapshots.upstream = FlakyProvider(RATES, down = ['CAD'])
+
+    assert first['rate'] == 1.35
+    assert snapshots.rate('USD', 'CAD') == first
+    assert CurrencyRate.query.count() == 1
+
+
+def test_snapshot_provider_warns_about_old_snapshots(app, snapshots, caplog):
+    snapshot = CurrencyRate.add('MXN', 17.0)
+    snapshot.fetched_at = datetime.utcnow() - timedelta(days = 2)
+    db.session.commit()
+
+    with caplog.at_level(logging.WARNING, logger = 'convert'):
+        assert snapshots.rate('USD', 'MXN')['rate'] == 17.0
+
+    assert 'refresh-rates' in caplog.text
+
+
+def test_order_records_the_rate_it_was_priced_at(app, client, snapshots):
+    snapshot = CurrencyRate.add('MXN', 17.05)
+    user = make_user('comprador', location = 'Mexico')
+    bread = make_product('Bread', price = 3.25)
+    login(client, 'comprador')
+    client.post(f"/products/{bread.id}", data = {'quantity': 2})
+
+    assert client.post('/cart', data = {}).status_code == 302
+
+    order = Order.query.filter_by(user_id = user.id).one()
+    assert (order.currency, order.rate_id, order.total_cents) == ('MXN', snapshot.id, 11082)
+
+
+def test_usd_orders_have_no_rate(app, client, snapshots):
+    user = make_user('buyer')
+    bread = make_product('Bread', price = 3.25)
+    login(client, 'buyer')
+    client.post(f"/products/{bread.id}", data = {'quantity': 1})
+    client.post('/cart', data = {})
+
+    order = Order.query.filter_by(user_id = user.id).one()
+    assert (order.currency, order.rate_id, order.total_cents) == ('USD', None, 325)
+
+
+def test_refresh_command_fails_when_a_rate_was_not_refreshed(app, monkeypatch):
+    monkeypatch.setattr(shop, 'refresh_rates', lambda: refresh_rates(FlakyProvider(RATES, down = ['MXN'])))
+
+    result = app.test_cli_runner().invoke(args = ['refresh-rates'])
+
+    assert result.exit_code == 1
+    assert 'CAD: 1.35' in result.output and 'MXN: not refreshed' in result.output
+
+
+class Stop(Exception):
+    pass
+
+
+def test_refresh_loop_survives_failed_rounds(app, monkeypatch):
+    rounds = iter([RuntimeError("database went away"), ValueError("forex said no"), None])
+
+    def refresh():
+        error = next(rounds)
+        if error is not None:
+            raise error
+        return refresh_rates(FixtureProvider(RATES))
+
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 3:
+            raise Stop()
+
+    monkeypatch.setattr(shop, 'refresh_rates', refresh)
+    monkeypatch.setattr(shop.time, 'sleep', sleep)
+
+    result = app.test_cli_runner().invoke(args = ['refresh-rates', '--every', '60'])
+
+    assert isinstance(result.exception, Stop)
+    assert sleeps == [60, 60, 60]
+    assert 'Refresh failed' in result.output and 'MXN: 17.05' in result.output
@@ -0,0 +1,60 @@
+from app import product_card
+from conftest import make_product
+from fragments import FragmentCache
+from models import db, Product
+
+USD = {'label': 'USD', 'rate': 1, 'rate_id': None}
+
+
+def test_evicts_least_recently_used_past_the_byte_cap():
+    cache = FragmentCache(max_bytes = 10)
+    cache.set((1, 'a'), 'xxxx')
+    cache.set((2, 'a'), 'xxxx')
+    cache.get((1, 'a'))                                 # 1 is now the most recent
+    cache.set((3, 'a'), 'xxxx')
+
+    assert cache.get((2, 'a')) is None
+    assert cache.get((1, 'a')) == 'xxxx' and cache.get((3, 'a')) == 'xxxx'
+    assert cache.size == 8
+
+
+def test_replacing_an_entry_counts_its_new_size():
+    cache = FragmentCache(max_bytes = 10)
+    cache.set((1, 'a'), 'xxxxxx')
+    cache.set((1, 'a'), 'xx')
+    cache.set((2, 'a'), 'xxxxxxxx')
+
+    assert cache.size == 10
+    assert cache.get((1, 'a')) == 'xx'
+
+
+def test_an_entry_bigger_than_the_cap_is_not_kept():
+    cache = FragmentCache(max_bytes = 4)
+    cache.set((1, 'a'), 'xxxxx')
+
+    assert cache.get((1, 'a')) is None and cache.size == 0
+
+
+def test_drop_product_drops_only_that_product():
+    cache = FragmentCache()
+    cache.set((1, 1, 'USD'), 'aa')
+    cache.set((1, 2, 'MXN'), 'bbb')
+    cache.set((2, 1, 'USD'), 'c')
+
+    cache.drop_product(1)
+
+    assert cache.get((1, 1, 'USD')) is None and cache.get((1, 2, 'MXN')) is None
+    assert cache.get((2, 1, 'USD')) == 'c' and cache.size == 1
+
+
+def test_edited_price_shows_in_the_next_card(app):
+    bread = make_product('Bread', price = 3.25)
+
+    with app.test_request_context():
+        assert '3.25' in product_card(bread, USD)
+
+        Product.edit(bread.id, 'Bread', 'Snacks', 100, 'Bread description', 4.10, 10, '')
+        db.session.commit()
+
+        card = product_card(db.session.get(Product, bread.id), USD)
+        assert '4.10' in card and '3.25' not in card
@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+from app import load_user, is_admin
+from conftest import make_user, login, PASSWORD
+from identity import IdentityCache, identities
+
+
+class Users():
+    '''load_user stand-in that counts lookups.'''
+
+    def __init__(self):
+        self.rows = {1: SimpleNamespace(id = 1, username = 'ann', location = 'USA', image_url = None)}
+        self.loads = 0
+        self.during_load = None
+
+    def __call__(self, user_id):
+        self.loads += 1
+        row = self.rows.get(user_id)
+        if self.during_load:
+            self.during_load()
+        return row and SimpleNamespace(**vars(row))
+
+
+not_admin = lambda user: False
+
+
+def test_hits_do_not_load():
+    users, cache = Users(), IdentityCache()
+
+    assert cache.get(1, users, not_admin).location == 'USA'
+    assert cache.get(1, users, not_admin).location == 'USA'
+    assert users.loads == 1
+    assert cache.get(2, users, not_admin) is None
+
+
+def test_invalidate_reloads():
+    users, cache = Users(), IdentityCache()
+    cache.get(1, users, not_admin)
+
+    users.rows[1].location = 'Mexico'
+    cache.invalidate(1)
+
+    assert cache.get(1, users, not_admin).location == 'Mexico'
+    assert users.loads == 2
+
+
+def test_invalidate_during_a_load_keeps_the_old_read_out():
+    users, cache = Users(), IdentityCache()
+    users.during_load = lambda: cache.invalidate(1)     # an edit commits while the lookup reads
+
+    cache.get(1, users, not_admin)
+    users.during_load = None
+    cache.get(1, users, not_admin)
+
+    assert users.loads == 2
+
+
+def test_entries_expire_and_are_bounded():
+    users = Users()
+    users.rows[2] = SimpleNamespace(id = 2, username = 'bob', location = 'Canada', image_url = None)
+
+    cache = IdentityCache(ttl = 0)
+    cache.get(1, users, not_admin)
+    cache.get(1, users, not_admin)
+    assert users.loads == 2
+
+    cache = IdentityCache(size = 1)
+    cache.get(1, users, not_admin)
+    cache.get(2, users, not_admin)
+    cache.get(1, users, not_admin)
+    assert users.loads == 5
+
+
+def test_profile_edit_shows_up_on_the_next_request(app, client):
+    user = make_user('ann')
+    login(client, 'ann')
+    client.get('/')                                     # caches the identity
+
+    response = client.post('/users/update', data = {'location': 'Mexico', 'password': PASSWORD})
+
+    assert response.status_code == 302
+    assert identities.get(user.id, load_user, is_admin).location == 'Mexico'
@@ -0,0 +1,12 @@
+import pytest
+
+
+def test_server_timing_is_off_by_default(app, client):
+    assert 'Server-Timing' not in client.get('/login').headers
+
+
+@pytest.mark.parametrize('config', [{'SERVER_TIMING': True}])
+def test_server_timing_when_asked_for(app, client):
+    header = client.get('/login').headers['Server-Timing']
+
+    assert header.startswith('app;dur=')
@@ -0,0 +1,146 @@
+import logging
+import time
+
+from app import checkout_worker
+from conftest import make_user, make_product
+from jobs import Worker, MemoryJobQueue, DBJobQueue
+from models import db, Job, Order, OrderProduct, Product
+
+USD = {'label': 'USD', 'rate_id': None}
+
+
+class Handler():
+    '''run fails the first `failures` times; give_up records its calls.'''
+
+    def __init__(self, failures = 0, give_up_fails = False):
+        self.failures = failures
+        self.give_up_fails = give_up_fails
+        self.runs = []
+        self.given_up = []
+
+    def run(self, n):
+        self.runs.append(n)
+        if len(self.runs) <= self.failures:
+            raise RuntimeError(f"failure {len(self.runs)}")
+
+    def give_up(self, n):
+        self.given_up.append(n)
+        if self.give_up_fails:
+            raise RuntimeError("give up failed too")
+
+    def worker(self, queue, max_attempts = 3):
+        return Worker(queue, {'count': (self.run, self.give_up)}, max_attempts = max_attempts, backoff = 0)
+
+
+def drain(worker, rounds = 10):
+    for _ in range(rounds):
+        worker.run_once()
+
+
+def job_row():
+    db.session.expire_all()
+    return Job.query.one()
+
+
+def test_memory_queue_retries_until_it_works(app):
+    queue, handler = MemoryJobQueue(), Handler(failures = 2)
+    queue.enqueue('count', {'n': 1})
+
+    drain(handler.worker(queue))
+
+    assert handler.runs == [1, 1, 1]
+    assert handler.given_up == [] and queue.failed == [] and len(queue) == 0
+
+
+def test_memory_queue_gives_up_after_max_attempts(app, caplog):
+    queue, handler = MemoryJobQueue(), Handler(failures = 10)
+    queue.enqueue('count', {'n': 1})
+
+    drain(handler.worker(queue))
+
+    assert handler.runs == [1, 1, 1]
+    assert handler.given_up == [1]
+    [(job, error)] = queue.failed
+    assert job.attempts == 3 and error == 'RuntimeError: failure 3'
+    assert 'failed after 3 attempts' in caplog.text
+
+
+def test_retries_back_off(app):
+    queue, handler = MemoryJobQueue(), Handler(failures = 1)
+    queue.enqueue('count', {'n': 1})
+    worker = Worker(queue, {'count': (handler.run, handler.give_up)}, backoff = 60)
+
+    worker.run_once()
+    worker.run_once()
+
+    assert handler.runs == [1]
+    assert len(queue) == 1 and queue._jobs[0].run_after > time.time() + 50
+
+
+def test_unknown_jobs_fail_at_once(app):
+    queue = MemoryJobQueue()
+    queue.enqueue('mystery', {})
+
+    Worker(queue, {}).run_once()
+
+    assert [e for _, e in queue.failed] == ['LookupError: no handler for mystery jobs']
+
+
+def test_a_failing_give_up_still_fails_the_job(app, caplog):
+    queue, handler = MemoryJobQueue(), Handler(failures = 10, give_up_fails = True)
+    queue.enqueue('count', {'n': 1})
+    queue.enqueue('count', {'n': 2})
+
+    with caplog.at_level(logging.ERROR, logger = 'jobs'):
+        drain(handler.worker(queue, max_attempts = 1))
+
+    assert handler.given_up == [1, 2]                   # the second job still ran after the first blew up
+    assert [e for _, e in queue.failed] == ['RuntimeError: failure 1; give up: RuntimeError: give up failed too',
+                                            'RuntimeError: failure 2; give up: RuntimeError: give up failed too']
+    assert caplog.text.count('giving up count job') == 2
+
+
+def test_db_queue_counts_attempts_and_records_failure(app):
+    queue, handler = DBJobQueue(), Handler(failures = 10, give_up_fails = True)
+    queue.enqueue('count', {'n': 1})
+    db.session.commit()
+
+    drain(handler.worker(queue))
+
+    job = job_row()
+    assert (job.status, job.attempts) == ('failed', 3)
+    assert job.last_error.startswith('RuntimeError: failure 3; give up:')
+    assert handler.runs == [1, 1, 1]
+
+
+def test_db_queue_reclaims_jobs_of_dead_workers(app):
+    queue = DBJobQueue(stale_after = 0)
+    queue.enqueue('count', {'n': 1})
+    db.session.commit()
+
+    assert len(queue.claim(10)) == 1                    # this worker "dies" here
+    time.sleep(0.01)
+    [job] = queue.claim(10)
+
+    assert job.attempts == 2
+
+
+def test_async_checkout_gives_up_by_putting_stock_back(app, monkeypatch):
+    user = make_user('buyer')
+    product = make_product('Bread', quantity = 5)
+    queue = MemoryJobQueue()
+    order = Order.reserve(user.id, 500, [[product, 2]], USD, queue)
+    assert db.session.get(Product, product.id).quantity == 3
+
+    def broken(order_id, lines):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(Order, 'finalize', broken)
+    worker = checkout_worker(queue, {'CHECKOUT_MAX_ATTEMPTS': 2})
+    worker.backoff = 0
+    drain(worker)
+
+    db.session.expire_all()
+    assert db.session.get(Order, order.id).status == 'failed'
+    assert db.session.get(Product, product.id).quantity == 5
+    assert OrderProduct.query.count() == 0
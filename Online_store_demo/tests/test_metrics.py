@@ -0,0 +1,33 @@
+import pytest
+
+from app import ADMIN_ID
+from conftest import make_user, login
+
+
+@pytest.fixture
+def config():
+    return {'METRICS_TOKEN': 's3cret'}
+
+
+def test_metrics_are_not_public(app, client):
+    make_user('shopper')
+
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', headers = {'Authorization': 'Bearer wrong'}).status_code == 403
+    assert login(client, 'shopper').get('/metrics').status_code == 403
+
+
+def test_metrics_for_the_admin_and_the_scraper(app, client):
+    make_user(ADMIN_ID)
+
+    response = client.get('/metrics', headers = {'Authorization': 'Bearer s3cret'})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+
+    assert login(client, ADMIN_ID).get('/metrics').status_code == 200
+
+
+@pytest.mark.parametrize('config', [{}])
+def test_no_token_configured_means_admin_only(app, client):
+    assert client.get('/metrics', headers = {'Authorization': 'Bearer '}).status_code == 403
+    assert client.get('/metrics', headers = {'Authorization': 'Bearer None'}).status_code == 403
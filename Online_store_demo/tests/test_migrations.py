@@ -0,0 +1,83 @@
+import sqlalchemy as sa
+
+from models import db, LocationCurrency
+import migrations
+import sales
+
+
+def currencies():
+    return {l.location: l.currency for l in LocationCurrency.query.all()}
+
+
+def test_upgrade_adds_location_currencies(app):
+    assert currencies() == {'USA': 'USD', 'Canada': 'CAD', 'Mexico': 'MXN'}
+
+
+def test_location_currencies_keep_rows_an_admin_added(app):
+    with db.engine.begin() as conn:
+        conn.execute(sa.delete(LocationCurrency.__table__))
+        conn.execute(sa.insert(LocationCurrency.__table__), [{'location': 'Canada', 'currency': 'USD'}])
+        conn.execute(sa.delete(migrations.schema_migrations)
+                       .where(migrations.schema_migrations.c.version == '0007'))
+
+    assert migrations.upgrade(db.engine, log = lambda line: None) == ['0007']
+    assert currencies() == {'USA': 'USD', 'Canada': 'USD', 'Mexico': 'MXN'}
+
+
+LEGACY_SCHEMA = [                                       # what db.create_all() built before the migrations
+    '''CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT NOT NULL UNIQUE, email TEXT NOT NULL UNIQUE,
+                           image_url TEXT, location TEXT, address TEXT, password TEXT NOT NULL)''',
+    '''CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, category TEXT NOT NULL,
+                              weight INTEGER, description TEXT, price FLOAT NOT NULL, quantity INTEGER,
+                              image_url TEXT)''',
+    '''CREATE TABLE orders (id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES users (id),
+                            timestamp DATETIME NOT NULL, total FLOAT NOT NULL)''',
+    '''CREATE TABLE orders_products (id INTEGER PRIMARY KEY, order_id INTEGER REFERENCES orders (id),
+                                     product_id INTEGER REFERENCES products (id), quantity INTEGER)''',
+]
+
+
+def test_upgrade_labels_old_orders_with_the_buyers_currency(tmp_path):
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        for statement in LEGACY_SCHEMA:
+            conn.execute(sa.text(statement))
+        conn.execute(sa.text('''INSERT INTO users (id, username, email, location, password) VALUES
+                                (1, 'us', 'us@example.com', 'USA', 'x'),
+                                (2, 'ca', 'ca@example.com', 'Canada', 'x'),
+                                (3, 'mx', 'mx@example.com', 'Mexico', 'x'),
+                                (4, 'xx', 'xx@example.com', NULL, 'x')'''))
+        conn.execute(sa.text('''INSERT INTO orders (id, user_id, timestamp, total) VALUES
+                                (1, 1, '2023-01-01', 3.25), (2, 2, '2023-01-01', 4.39),
+                                (3, 3, '2023-01-01', 55.41), (4, 4, '2023-01-01', 1.0)'''))
+
+    migrations.upgrade(engine, log = lambda line: None)
+
+    with engine.begin() as conn:
+        orders = conn.execute(sa.text("SELECT id, currency, total_cents FROM orders ORDER BY id")).all()
+    assert [tuple(o) for o in orders] == [(1, 'USD', 325), (2, 'CAD', 439), (3, 'MXN', 5541), (4, 'USD', 100)]
+    engine.dispose()
+
+
+def test_upgrade_freezes_old_order_lines_at_the_price_they_had(tmp_path):
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        for statement in LEGACY_SCHEMA:
+            conn.execute(sa.text(statement))
+        conn.execute(sa.text("INSERT INTO users (id, username, email, location, password) "
+                             "VALUES (1, 'us', 'us@example.com', 'USA', 'x')"))
+        conn.execute(sa.text("INSERT INTO products (id, name, category, price, quantity) "
+                             "VALUES (1, 'Milk', 'Dairy', 1.10, 5)"))
+        conn.execute(sa.text("INSERT INTO orders (id, user_id, timestamp, total) VALUES (1, 1, '2023-01-01', 2.20)"))
+        conn.execute(sa.text("INSERT INTO orders_products (order_id, product_id, quantity) VALUES (1, 1, 2)"))
+
+    migrations.upgrade(engine, log = lambda line: None)
+    with engine.begin() as conn:
+        conn.execute(sa.text("UPDATE products SET price_cents = 199"))
+        sales.rebuild(conn)
+        lines = conn.execute(sa.text("SELECT price_cents, category FROM orders_products")).all()
+        rollup = conn.execute(sa.text("SELECT category, units, revenue_cents FROM sales_category_day")).all()
+
+    assert [tuple(l) for l in lines] == [(110, 'Dairy')]
+    assert [tuple(r) for r in rollup] == [('Dairy', 2, 220)]
+    engine.dispose()
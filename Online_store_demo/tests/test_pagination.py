@@ -0,0 +1,58 @@
+import base64
+import json
+
+import pytest
+
+from models import Product
+from pagination import encode_cursor, decode_cursor, load_cursor, finite_float
+from conftest import make_user, make_product, login
+
+
+def raw_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(['Bread', 3])) == ['Bread', 3]
+    assert decode_cursor('not base64 json!') is None
+    assert decode_cursor(None) is None
+
+
+@pytest.mark.parametrize('value', [5, 'abc', {'a': 1}, [1], [1, 2, 3], None, ['x', 'y']])
+def test_load_cursor_rejects_wrong_shapes(value):
+    assert load_cursor(raw_cursor(value), [str, int]) is None
+
+
+def test_load_cursor_converts_per_column():
+    assert load_cursor(raw_cursor(['Bread', '7']), [str, int]) == ['Bread', 7]
+    assert load_cursor(raw_cursor([0.5, 1]), [finite_float, int]) == [0.5, 1]
+    assert load_cursor(encode_cursor([float('nan'), 1]), [finite_float, int]) is None
+
+
+def test_pages_walk_forward_and_back(app):
+    for n in range(7):
+        make_product(f"product-{n}")
+
+    first = Product.page(3)
+    second = Product.page(3, after = first.next_cursor)
+    third = Product.page(3, after = second.next_cursor)
+    back = Product.page(3, before = second.prev_cursor)
+
+    assert [p.name for p in first] == ['product-0', 'product-1', 'product-2']
+    assert [p.name for p in second] == ['product-3', 'product-4', 'product-5']
+    assert [p.name for p in third] == ['product-6'] and third.next_cursor is None
+    assert [p.name for p in back] == [p.name for p in first] and back.prev_cursor is None
+
+
+@pytest.mark.parametrize('value', [5, 'abc', {'a': 1}, [1], [1, 2, 3], ['x', 'y']])
+def test_bad_cursors_show_the_first_page(app, client, value):
+    user = make_user('buyer')
+    make_product('Bread', category = 'Bread')
+    login(client, 'buyer')
+
+    cursor = raw_cursor(value)
+    for url in ['/', '/categories/Bread', '/search?q=bread&', f"/users/{user.id}/orders"]:
+        sep = '' if url.endswith('&') else '?'
+        for param in ('after', 'before'):
+            response = client.get(f"{url}{sep}{param}={cursor}")
+            assert response.status_code == 200, (url, param)
@@ -0,0 +1,64 @@
+import pytest
+import sqlalchemy as sa
+
+from conftest import make_user, PASSWORD
+from models import db, User
+from passwords import passwords, PasswordHasher
+
+
+def cost(hashed):
+    return int(hashed.split('$')[2])
+
+
+@pytest.fixture
+def statements(app):
+    '''SQL statements run on the app's engine while the test body runs.'''
+
+    seen = []
+    record = lambda conn, cursor, statement, *args: seen.append(statement)
+    sa.event.listen(db.engine, 'before_cursor_execute', record)
+    yield seen
+    sa.event.remove(db.engine, 'before_cursor_execute', record)
+
+
+def test_hash_and_verify():
+    hasher = PasswordHasher(rounds = 4, workers = 1)
+    hashed = hasher.hash('secret')
+
+    assert cost(hashed) == 4
+    assert hasher.verify(hashed, 'secret') and not hasher.verify(hashed, 'guess')
+
+
+@pytest.mark.parametrize('hashed, stale', [
+    ('$2b$04$' + 'a' * 53, False), ('$2b$12$' + 'a' * 53, True), ('plaintext', True), ('$2b$xx$', True),
+])
+def test_needs_rehash(hashed, stale):
+    assert PasswordHasher(rounds = 4, workers = 1).needs_rehash(hashed) == stale
+
+
+def test_login_rehashes_at_the_current_cost(app, monkeypatch):
+    make_user('ann')
+    monkeypatch.setattr(passwords, 'rounds', 5)
+
+    assert not User.authenticate('ann', 'wrong')
+    assert cost(User.query.filter_by(username = 'ann').one().password) == 4
+
+    user = User.authenticate('ann', PASSWORD)
+    rehashed = user.password
+    assert cost(rehashed) == 5
+
+    db.session.expire_all()
+    assert User.authenticate('ann', PASSWORD).password == rehashed     # already current, kept as is
+
+
+def test_edit_uses_the_loaded_user(app, statements):
+    user = make_user('ann')
+    db.session.refresh(user)
+    statements.clear()
+
+    edited = User.edit(user, 'new@example.com', None, PASSWORD, 'Canada', 'elsewhere')
+
+    assert edited is user
+    assert statements == []
+    assert not User.edit(user, 'x@example.com', None, 'wrong', 'Mexico', 'x')
+    assert user.location == 'Canada'
@@ -0,0 +1,60 @@
+from decimal import Decimal
+
+import pytest
+
+from pricing import PriceBook, to_minor, format_minor, convert, convert_all
+
+
+@pytest.mark.parametrize('amount, cents', [
+    (3.25, 325), ('0.015', 2), ('0.014', 1), (Decimal('19.995'), 2000), (1.005, 101), (0, 0),
+])
+def test_to_minor_rounds_half_up(amount, cents):
+    assert to_minor(amount) == cents
+
+
+@pytest.mark.parametrize('cents, text', [(0, '0.00'), (5, '0.05'), (325, '3.25'), (-120, '-1.20')])
+def test_format_minor(cents, text):
+    assert format_minor(cents) == text
+
+
+@pytest.mark.parametrize('cents, rate, converted', [
+    (100, 17.05, 1705),
+    (325, 17.05, 5541),                                 # 5541.25
+    (1, 1.35, 1),                                       # 1.35
+    (10, 1.35, 14),                                     # 13.5, half rounds up
+    (30, 0.05, 2),                                      # 1.5
+    (1, 0.4, 0),
+    (589, 1, 589),
+])
+def test_convert_rounds_half_up(cents, rate, converted):
+    assert convert(cents, rate) == converted
+
+
+def test_convert_is_exact_where_floats_are_not():
+    assert 1.15 * 100 != 115                            # why prices are integer cents
+    assert convert(100, 1.15) == 115
+    assert convert(10 ** 9, 17.05) == 17_050_000_000
+
+
+def test_convert_all_matches_convert():
+    minors = [0, 1, 10, 325, 589, 99_999]
+    assert list(convert_all(minors, 17.05)) == [convert(m, 17.05) for m in minors]
+
+
+def test_price_book_converts_once_per_rate_and_version():
+    loads, version = [], [1]
+
+    def load():
+        loads.append(version[0])
+        return [1, 2], [100, 325]
+
+    book = PriceBook(load, lambda: version[0])
+    mxn = {'label': 'MXN', 'rate': 17.05, 'rate_id': 1}
+
+    assert book.prices(mxn) == {1: 1705, 2: 5541}
+    assert book.prices({'label': 'USD', 'rate': 1, 'rate_id': None}) == {1: 100, 2: 325}
+    assert loads == [1]
+
+    version[0] = 2
+    book.prices(mxn)
+    assert loads == [1, 2]
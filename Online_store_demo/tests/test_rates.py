@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+from convert import RateCache
+
+
+class SlowProvider():
+    '''Counts calls and takes a while, like a network round trip.'''
+
+    def __init__(self, rate = 17.0, delay = 0.05):
+        self.rate_value = rate
+        self.delay = delay
+        self.calls = 0
+        self.fail = False
+        self._lock = threading.Lock()
+
+    def rate(self, base, conv_to):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError("provider down")
+        return self.rate_value
+
+
+def run_together(n, fn):
+    barrier = threading.Barrier(n)
+    results = []
+
+    def call():
+        barrier.wait()
+        results.append(fn())
+
+    threads = [threading.Thread(target = call) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_cold_cache_fetches_once_for_everyone():
+    provider = SlowProvider()
+    cache = RateCache(provider, ttl = 60)
+
+    results = run_together(10, lambda: cache.get('USD', 'MXN'))
+
+    assert provider.calls == 1
+    assert results == [17.0] * 10
+
+
+def test_stale_rate_is_served_while_one_caller_refreshes():
+    provider = SlowProvider(delay = 0.2)
+    cache = RateCache(provider, ttl = 0.01)
+    cache.get('USD', 'MXN')
+    provider.rate_value = 18.0
+    time.sleep(0.02)
+
+    start = time.monotonic()
+    results = run_together(10, lambda: cache.get('USD', 'MXN'))
+
+    assert provider.calls == 2                          # the first fill plus exactly one refresh
+    assert sorted(results) == [17.0] * 9 + [18.0]
+    assert cache.get('USD', 'MXN') == 18.0
+    assert time.monotonic() - start < 1
+
+
+def test_provider_failure_keeps_last_rate():
+    provider = SlowProvider(delay = 0)
+    cache = RateCache(provider, ttl = 0)
+    assert cache.get('USD', 'CAD') == 17.0
+
+    provider.fail = True
+    assert cache.get('USD', 'CAD') == 17.0
+
+
+def test_provider_failure_without_a_rate_raises():
+    provider = SlowProvider(delay = 0)
+    provider.fail = True
+
+    with pytest.raises(ConnectionError):
+        RateCache(provider).get('USD', 'CAD')
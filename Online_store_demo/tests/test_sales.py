@@ -0,0 +1,72 @@
+from datetime import date, datetime, timedelta
+
+from conftest import make_user, make_product
+from jobs import MemoryJobQueue
+from models import db, Order, Product, ProductSales, CategorySales
+import sales
+
+USD = {'label': 'USD', 'rate_id': None}
+
+
+def rollups():
+    db.session.expire_all()
+    return (sorted((str(r.day), r.product_id, r.units, r.revenue_cents) for r in ProductSales.query),
+            sorted((str(r.day), r.category, r.units, r.revenue_cents) for r in CategorySales.query))
+
+
+def rebuilt():
+    with db.engine.begin() as conn:
+        sales.rebuild(conn)
+    return rollups()
+
+
+def test_rebuild_agrees_with_live_rollups_after_renames_and_deletes(app):
+    user = make_user('buyer')
+    bread = make_product('Bread', price = 3.25, category = 'Bread')
+    milk = make_product('Milk', price = 1.10, category = 'Dairy')
+
+    Order.add(user.id, 0, [[bread, 2], [milk, 1]], USD)
+    queue = MemoryJobQueue()
+    pending = Order.reserve(user.id, 0, [[milk, 3]], USD, queue)
+    Order.finalize(**queue.claim(1)[0].payload)
+
+    bread.category, bread.price_cents = 'Bakery', 400
+    db.session.commit()
+    db.session.delete(db.session.get(Product, milk.id))
+    db.session.commit()
+
+    live = rollups()
+    assert live[1] == [(str(date.today()), 'Bread', 2, 650), (str(date.today()), 'Dairy', 4, 440)]
+    assert db.session.get(Order, pending.id).status == 'placed'
+    assert rebuilt() == live
+
+
+def test_report_names_deleted_products(app):
+    user = make_user('buyer')
+    milk = make_product('Milk', price = 1.10, category = 'Dairy')
+    Order.add(user.id, 0, [[milk, 1]], USD)
+    db.session.delete(milk)
+    db.session.commit()
+    rebuilt()
+
+    report = sales.report(*sales.last_days(1))
+
+    assert report['products'] == [(f"#{milk.id} (deleted)", 1, 110)]
+    assert (report['units'], report['revenue']) == (1, 110)
+
+
+def test_finalize_reads_jobs_queued_before_lines_had_a_category(app):
+    user = make_user('buyer')
+    bread = make_product('Bread', price = 3.25, category = 'Bread')
+    queue = MemoryJobQueue()
+    order = Order.reserve(user.id, 0, [[bread, 2]], USD, queue)
+
+    Order.finalize(order.id, [[bread.id, 2, 300]])      # [product id, quantity, price] from an older release
+
+    assert [(l.price_cents, l.category) for l in db.session.get(Order, order.id).lines] == [(300, 'Bread')]
+    assert rollups()[1] == [(str(date.today()), 'Bread', 2, 600)]
+
+
+def test_last_days_end_on_the_utc_date():
+    assert sales.last_days(30) == (datetime.utcnow().date() - timedelta(days = 29), datetime.utcnow().date())
+    assert sales.last_days(1, date(2023, 3, 1)) == (date(2023, 3, 1), date(2023, 3, 1))
@@ -0,0 +1,79 @@
+import pytest
+
+from conftest import make_user, make_product, login
+from models import db, Product
+from search import SqliteSearch
+
+
+def names(page):
+    return [p.name for p in page]
+
+
+def test_name_match_ranks_above_description_match(app):
+    Product.add('Rye loaf', 'Bakery', 100, 'goes well with a cracker', 3.25, 10, '')
+    make_product('Cracker')
+
+    assert names(Product.search('cracker', 10)) == ['Cracker', 'Rye loaf']
+
+
+def test_prefix_and_stemming(app):
+    make_product('Chocolate bar')
+    make_product('Salty cucumbers')
+
+    assert names(Product.search('choc', 10)) == ['Chocolate bar']
+    assert names(Product.search('cucumber', 10)) == ['Salty cucumbers']
+
+
+def test_index_follows_edits_and_deletes(app):
+    bread = make_product('Bread loaf')
+
+    Product.edit(bread.id, 'Sourdough', 'Snacks', 100, 'tangy', 3.25, 10, '')
+    db.session.commit()
+    assert names(Product.search('bread', 10)) == []
+    assert names(Product.search('sourdough', 10)) == ['Sourdough']
+
+    db.session.delete(bread)
+    db.session.commit()
+    assert names(Product.search('sourdough', 10)) == []
+
+
+def test_paging_over_equal_ranks_is_complete(app):
+    for n in range(7):
+        make_product(f"Jam {n}")                        # same text shape, same rank
+
+    pages, page = [], Product.search('jam', 3)
+    while True:
+        pages.append(names(page))
+        if not page.next_cursor:
+            break
+        page = Product.search('jam', 3, after = page.next_cursor)
+
+    found = [n for p in pages for n in p]
+    assert sorted(found) == [f"Jam {n}" for n in range(7)] and len(found) == 7
+
+    last = Product.search('jam', 3, after = Product.search('jam', 3).next_cursor)
+    back = Product.search('jam', 3, before = last.prev_cursor)
+    assert names(back) == pages[0]
+
+
+@pytest.mark.parametrize('terms', ['"', '*', '()', '-- ;', 'AND OR NOT', 'bread"'])
+def test_punctuation_and_operators_do_not_break_search(app, terms):
+    make_product('Bread loaf')
+
+    result = names(Product.search(terms, 10))
+
+    assert result == (['Bread loaf'] if 'bread' in terms else [])
+
+
+def test_fts_query_quotes_words():
+    assert SqliteSearch.fts_query('choc "bar') == '"choc" "bar"*'
+    assert SqliteSearch.fts_query('?!') is None
+
+
+def test_search_page(app, client):
+    make_user('ann')
+    make_product('Bread loaf')
+    login(client, 'ann')
+
+    assert b'Bread loaf' in client.get('/search?q=bread').data
+    assert client.get('/search?q=%22%28').status_code == 200
@@ -0,0 +1,52 @@
+import pytest
+
+from throttle import Throttle, MemoryBucketStore, DBBucketStore
+
+
+@pytest.fixture
+def config():
+    return {'THROTTLE_IP': '2/60', 'PROXY_HOPS': 1}
+
+
+@pytest.mark.parametrize('store', [MemoryBucketStore, DBBucketStore])
+def test_bucket_empties_and_refills(app, store):
+    store = store()
+    take = lambda now: store.take('ip:1.2.3.4', 2, 1 / 30, now)
+
+    assert [take(1000.0), take(1000.0), take(1000.0)] == [True, True, False]
+    assert not take(1010.0)                             # a third of a token back
+    assert take(1030.0)
+    assert take(2000.0) and take(2000.0) and not take(2000.0)   # refills to capacity, no more
+
+
+def test_keys_have_their_own_buckets():
+    throttle = Throttle.from_spec(MemoryBucketStore(), '1/60')
+
+    assert throttle.allow('user:ann')
+    assert not throttle.allow('user:ann')
+    assert throttle.allow('user:bob')
+
+
+def test_memory_store_forgets_the_oldest_keys():
+    store = MemoryBucketStore(size = 2)
+    for key in ('a', 'b', 'c'):
+        store.take(key, 1, 0, 0.0)
+
+    assert store.take('a', 1, 0, 0.0)                   # evicted, starts full again
+    assert not store.take('c', 1, 0, 0.0)
+
+
+def login_from(client, ip):
+    return client.post('/login', data = {'username': 'nobody', 'password': 'x'},
+                       headers = {'X-Forwarded-For': ip}).status_code
+
+
+def test_ip_throttle_uses_the_forwarded_client_address(app, client):
+    assert [login_from(client, '10.0.0.1') for _ in range(3)][-1] == 429
+    assert login_from(client, '10.0.0.2') != 429
+
+
+@pytest.mark.parametrize('config', [{'THROTTLE_IP': '2/60'}])
+def test_forwarded_header_is_ignored_without_proxy_hops(app, client):
+    assert [login_from(client, '10.0.0.1') for _ in range(3)][-1] == 429
+    assert login_from(client, '10.0.0.2') == 429
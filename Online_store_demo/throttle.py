@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, ThrottleBucket
+
+
+def refill(tokens, updated_at, now, capacity, per_second):
+    return min(capacity, tokens + (now - updated_at) * per_second)
+
+
+class MemoryBucketStore():
+    '''Buckets for this process only, in a bounded LRU. Keys that fall off
+    the end simply start again with a full bucket.'''
+
+    def __init__(self, size = 10000):
+        self.size = size
+        self._buckets = OrderedDict()                   # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, per_second, now):
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (capacity, now))
+            tokens = refill(tokens, updated_at, now, capacity, per_second)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+
+            while len(self._buckets) > self.size:
+                self._buckets.popitem(last = False)
+
+        return allowed
+
+
+class DBBucketStore():
+    '''Buckets in the throttle_buckets table, shared by every worker.
+    The row is locked while it is updated (FOR UPDATE on Postgres).'''
+
+    def take(self, key, capacity, per_second, now):
+        bucket = (ThrottleBucket
+                  .query
+                  .filter(ThrottleBucket.key == key)
+                  .with_for_update()
+                  .first())
+
+        if bucket is None:
+            bucket = ThrottleBucket(key = key, tokens = capacity, updated_at = now)
+            db.session.add(bucket)
+
+        tokens = refill(bucket.tokens, bucket.updated_at, now, capacity, per_second)
+        allowed = tokens >= 1
+        bucket.tokens = tokens - 1 if allowed else tokens
+        bucket.updated_at = now
+
+        try:
+            db.session.commit()
+        except IntegrityError:                          # first attempt for this key raced another
+            db.session.rollback()
+            return self.take(key, capacity, per_second, now)
+        return allowed
+
+
+class Throttle():
+    '''Per-key token buckets: `capacity` attempts, refilled over `period` seconds.'''
+
+    def __init__(self, store, capacity, period):
+        self.store = store
+        self.capacity = capacity
+        self.per_second = capacity / period
+
+    @classmethod
+    def from_spec(cls, store, spec):
+        '''"5/60" -> 5 attempts per 60 seconds.'''
+
+        capacity, period = spec.split('/')
+        return cls(store, int(capacity), float(period))
+
+    def allow(self, key):
+        return self.store.take(key, self.capacity, self.per_second, time.time())
+
+
+def make_bucket_store(kind):
+    '''THROTTLE_STORE=memory (default) or db.'''
+
+    return DBBucketStore() if kind == 'db' else MemoryBucketStore()